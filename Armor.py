@@ -0,0 +1,256 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# pymaster.py - A Python version of the Mixmaster Remailer
+#
+# Copyright (C) 2013 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Conversion between binary Mixmaster packets and the armored form in which
+# they travel by email:
+#
+#   ::
+#   Remailer-Type: mixmaster-[version]
+#
+#   -----BEGIN REMAILER MESSAGE-----
+#   [packet length ]
+#   [message digest]
+#   [encoded packet]
+#   -----END REMAILER MESSAGE-----
+
+import binascii
+import string
+from Crypto.Hash import MD5
+from Config import config
+
+BEGIN = "-----BEGIN REMAILER MESSAGE-----"
+END = "-----END REMAILER MESSAGE-----"
+# This is the wrap width for Mixmaster Base64.
+WIDTH = 40
+# Every line of encoded packet represents this many Bytes of binary.
+LINEBYTES = WIDTH // 4 * 3
+# All Mixmaster packets are this size.
+PACKETSIZE = 20480
+# Chars that aren't part of the base64 alphabet.  Like the base64 decoder,
+# dearmor ignores them.
+NONBASE64 = string.maketrans("", "").translate(
+    None, string.ascii_letters + string.digits + "+/=")
+
+
+class ArmorError(Exception):
+    pass
+
+
+def header(binary):
+    """Return everything up to and including the digest line.
+    """
+    digest = binascii.b2a_base64(MD5.new(data=binary).digest())
+    return ("::\nRemailer-Type: mixmaster-%s\n\n%s\n%s\n%s"
+            % (config.get('general', 'version'), BEGIN, len(binary), digest))
+
+
+def wrap(binary):
+    """Encode a binary string as Base64 wrapped at WIDTH.  The result ends
+       with a newline.
+    """
+    s = binascii.b2a_base64(binary).replace("\n", "")
+    lines = [s[i:i + WIDTH] for i in xrange(0, len(s), WIDTH)]
+    lines.append("")
+    return "\n".join(lines)
+
+
+def armor(binary):
+    """Take a binary packet and return it armored, ready to be used as the
+       payload of an email.
+    """
+    return "%s%s%s\n" % (header(binary), wrap(binary), END)
+
+
+def armor_to_file(binary, f, blocksize=3000):
+    """As armor() but written directly to the file object f, a block at a
+       time.  The blocksize must be a multiple of LINEBYTES so each block
+       encodes to whole lines.
+    """
+    assert blocksize % LINEBYTES == 0
+    f.write(header(binary))
+    for i in xrange(0, len(binary), blocksize):
+        f.write(wrap(binary[i:i + blocksize]))
+    f.write(END + "\n")
+
+
+def dearmor(lines):
+    """Take an iterable of message body lines, without line endings, and
+       return a tuple of the binary packet and its digest.  The lines are
+       consumed one at a time so that junk can be rejected without reading
+       the whole message.  The base64 packet is length checked and digested
+       as it's read.
+    """
+    lines = iter(lines)
+    for lineno, line in enumerate(lines):
+        if line == BEGIN:
+            break
+        if lineno >= 10:
+            # Bounces frequently contain the Remailer messages.  Checking
+            # if the cutmarks are deep in the message is a good test.
+            raise ArmorError("Cutmarks not in top ten lines of payload")
+    else:
+        raise ArmorError("No cutmarks on this message")
+    try:
+        length = int(lines.next())
+        digest = binascii.a2b_base64(lines.next())
+    except (StopIteration, ValueError, binascii.Error):
+        raise ArmorError("Malformed packet length or digest")
+    if length != PACKETSIZE:
+        raise ArmorError("Incorrect packet length")
+    # Every 4 base64 chars encode 3 Bytes of packet.  Anything more than
+    # twice as long, even allowing for whitespace, can be rejected before
+    # it's decoded.
+    maxchars = (length + 2) // 3 * 8
+    encoded = 0
+    decoded = 0
+    md5 = MD5.new()
+    parts = []
+    batch = []
+    for line in lines:
+        if line == END:
+            break
+        encoded += len(line)
+        if encoded > maxchars:
+            raise ArmorError("Incorrect packet length")
+        batch.append(line)
+        if len(batch) == 128:
+            batch = [_decode(''.join(batch), md5, parts)]
+            decoded += len(parts[-1])
+            if decoded > length:
+                raise ArmorError("Incorrect packet length")
+    else:
+        raise ArmorError("No end cutmark on this message")
+    if _decode(''.join(batch), md5, parts):
+        raise ArmorError("Incorrect packet length")
+    packet = ''.join(parts)
+    if len(packet) != length:
+        raise ArmorError("Incorrect packet length")
+    if digest != md5.digest():
+        raise ArmorError("Mixmaster message digest failed")
+    return packet, digest
+
+
+def _decode(s, md5, parts):
+    """Decode as much of a base64 string as possible, appending the result
+       to parts and updating the digest.  Base64 can only be decoded in
+       groups of four chars so any remainder is returned.  Chars outside
+       the base64 alphabet are dropped before they're counted.
+    """
+    s = s.translate(None, NONBASE64)
+    usable = len(s) - (len(s) % 4)
+    try:
+        part = binascii.a2b_base64(s[:usable])
+    except binascii.Error:
+        raise ArmorError("Invalid base64 in packet")
+    if len(part) != usable // 4 * 3 - s[usable - 2:usable].count("="):
+        # The decoder stops at padding that isn't at the end.
+        raise ArmorError("Invalid base64 in packet")
+    md5.update(part)
+    parts.append(part)
+    return s[usable:]
+
+
+if (__name__ == "__main__"):
+    import time
+    import StringIO
+    import Crypto.Random
+
+    def legacy_armor(binary):
+        n = 40
+        length = len(binary)
+        digest = MD5.new(data=binary).digest().encode("base64")
+        s = binary.encode("base64")
+        s = ''.join(s.split("\n"))
+        header = "::\n"
+        header += ("Remailer-Type: mixmaster-%s\n\n"
+                   % config.get('general', 'version'))
+        header += "-----BEGIN REMAILER MESSAGE-----\n"
+        header += "%s\n" % length
+        header += "%s" % digest
+        payload = ""
+        while len(s) > 0:
+            payload += s[:n] + "\n"
+            s = s[n:]
+        payload += "-----END REMAILER MESSAGE-----\n"
+        return header + payload
+
+    def to_file(binary):
+        f = StringIO.StringIO()
+        armor_to_file(binary, f)
+        return f.getvalue()
+
+    iterations = 2000
+    binary = Crypto.Random.get_random_bytes(PACKETSIZE)
+    armored = armor(binary)
+    assert armored == legacy_armor(binary) == to_file(binary)
+    assert dearmor(armored.splitlines()) == (binary,
+                                             MD5.new(data=binary).digest())
+    # Trailing whitespace and stray chars are ignored, as they are by the
+    # base64 decoder.
+    padded = [l if l in (BEGIN, END) else l + " \t" for l in
+              armored.splitlines()]
+    assert dearmor(padded)[0] == binary
+    # Lines are consumed as they're needed, so an oversized packet is
+    # rejected without reading the rest of the message.
+    consumed = []
+
+    def stream(lines):
+        for line in lines:
+            consumed.append(line)
+            yield line
+
+    body = armored.splitlines()
+    begin = body.index(BEGIN)
+    end = body.index(END)
+    # The digest of something else.
+    digest = body[begin + 3][0:22] + "=="
+    oversized = body[:begin + 4] + [body[begin + 3]] * 10000 + \
+                body[begin + 4:]
+    for lines, error in ((oversized, "Incorrect packet length"),
+                         (body[:end - 1] + body[end:],
+                          "Incorrect packet length"),
+                         (body[:end], "No end cutmark on this message"),
+                         ([""] * 11 + body, "Cutmarks not in top ten lines "
+                                            "of payload"),
+                         (body[:begin + 2] + [digest] + body[begin + 3:],
+                          "Mixmaster message digest failed")):
+        del consumed[:]
+        try:
+            dearmor(stream(lines))
+            assert False, "%s: Not raised" % error
+        except ArmorError, e:
+            assert str(e) == error, e
+        assert len(consumed) < len(body) * 3
+    print "Dearmor self-check passed"
+    for name, func in (("Legacy", legacy_armor),
+                       ("Join", armor),
+                       ("Stream", to_file)):
+        start = time.time()
+        for n in xrange(iterations):
+            func(binary)
+        elapsed = time.time() - start
+        print "%-8s %8.0f packets/sec" % (name, iterations / elapsed)
+    lines = armored.splitlines()
+    start = time.time()
+    for n in xrange(iterations):
+        dearmor(lines)
+    elapsed = time.time() - start
+    print "%-8s %8.0f packets/sec" % ("Dearmor", iterations / elapsed)
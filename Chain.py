@@ -21,49 +21,51 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os.path
+import bisect
 import logging
-import Crypto.Random.random
 from Config import config
+import KeyManager
+import Utils
+import Watcher
 
 
 class ChainError(Exception):
     pass
 
 
-class Chain():
-    def __init__(self, pubring):
-        mlist2 = config.get('keys', 'mlist2')
-        if not os.path.isfile(mlist2):
-            raise ChainError("%s: Stats file not found" % mlist2)
+class Stats():
+    """The remailers in the mlist2 stats file that also have a Public Key.
+       The file is parsed once each time it or the Pubring changes, into a
+       table of latency, uptime and exit capability, ordered by latency.
+       Candidate queries take the latency range from the table by bisection
+       and their results are kept until the next change.
+    """
+    def __init__(self, mlist2, pubring):
         self.mlist2 = mlist2
-        self.shortname = config.get('general', 'shortname')
         self.pubring = pubring
-        # The following two variables define the time when the statfile was
-        # last modified.
-        self.exittime = 0
-        self.nodetime = 0
-        log.info("Chain handler initialised. Stats=%s", mlist2)
-
-    def _striplist(self, l):
-        """Take a list and return the same list with whitespace stripped from
-        each element.
-        """
-        assert type(l) is list
-        return ([x.strip() for x in l])
+        self.generation = None
+        # Tuples of (latency, uptime, name, exit), sorted by latency.
+        self.table = []
+        # The latencies from the table, in the same order, for bisection.
+        self.latencies = []
+        # Candidate lists, keyed by query.
+        self.queries = {}
 
-    def _randint(self, n):
-        """Return a random Integer (0-255)
+    def refresh(self):
+        """Reparse the stats if they or the Pubring have changed.
         """
-        return int(Crypto.Random.random.randint(0, n))
+        self.pubring.recache()
+        generation = (Watcher.generation(self.mlist2), self.pubring.generation)
+        if generation != self.generation:
+            log.debug("Repopulating remailer stats table.")
+            self.parse()
+            self.generation = generation
 
-    def candidates(self, minlat, maxlat, minup, exit=False):
-        """Returns a list of remailer shortnames, where each remailer meets
-        the latency, uptime and exit conditions requested.
-        """
+    def parse(self):
+        capstrings = self.pubring.get_capstrings()
+        table = []
         f = open(self.mlist2, 'r')
         instats = False
-        remailers = []
-        shortnames = self.pubring.get_names()
         for line in f:
             if line.startswith("Generated: "):
                 generated = line.split(": ", 1)[1].rstrip()
@@ -73,85 +75,106 @@ class Chain():
                 instats = False
             elif instats:
                 name = line[0:13].rstrip()
+                # This check ensures there is a public key corresponding to
+                # the candidate.  If not, we can't encrypt to it.
+                if not name in capstrings:
+                    log.warn("%s: In stats but no Public Key available.", name)
+                    continue
                 try:
                     lathrs = int(line[27:29].lstrip())
                 except ValueError:
                     lathrs = 0
                 latmin = int(line[30:32])
                 latency = (lathrs * 60) + latmin
-                if latency < minlat or latency > maxlat:
-                    continue
                 uptime = float(line[49:54].lstrip())
-                if uptime < minup:
-                    continue
                 opts = line[57:72]
-                if exit and 'D' in opts:
-                    continue
-                # This check ensures there is a public key corresponding to
-                # the candidate.  If not, we can't encrypt to it.
-                if name in shortnames:
-                    remailers.append(name)
-                else:
-                    log.warn("%s: In stats but no Public Key available.", name)
+                # Remailers flagged as middlemen, in either the stats or
+                # their capstring, can't be used as exits.
+                exit = not 'D' in opts and not 'M' in capstrings[name]
+                table.append((latency, uptime, name, exit))
         f.close()
-        return remailers
+        table.sort()
+        self.table = table
+        self.latencies = [row[0] for row in table]
+        self.queries = {}
+
+    def candidates(self, minlat, maxlat, minup, exit=False):
+        self.refresh()
+        query = (minlat, maxlat, minup, exit)
+        if not query in self.queries:
+            first = bisect.bisect_left(self.latencies, minlat)
+            last = bisect.bisect_right(self.latencies, maxlat)
+            self.queries[query] = [name for latency, uptime, name, isexit
+                                   in self.table[first:last]
+                                   if uptime >= minup and
+                                   (isexit or not exit)]
+        return self.queries[query]
+
+
+class Chain():
+    def __init__(self, pubring):
+        mlist2 = config.get('keys', 'mlist2')
+        if not os.path.isfile(mlist2):
+            raise ChainError("%s: Stats file not found" % mlist2)
+        self.mlist2 = mlist2
+        self.shortname = config.get('general', 'shortname')
+        self.pubring = pubring
+        self.stats = Stats(mlist2, pubring)
+        self.minlat = config.getint('chain', 'minlat')
+        self.maxlat = config.getint('chain', 'maxlat')
+        self.relfinal = config.getfloat('chain', 'relfinal')
+        log.info("Chain handler initialised. Stats=%s", mlist2)
+
+    def _striplist(self, l):
+        """Take a list and return the same list with whitespace stripped from
+        each element.
+        """
+        assert type(l) is list
+        return ([x.strip() for x in l])
+
+    def candidates(self, minlat, maxlat, minup, exit=False):
+        """Returns a list of remailer shortnames, where each remailer meets
+        the latency, uptime and exit conditions requested.
+        """
+        return self.stats.candidates(minlat, maxlat, minup, exit)
+
+    def get_exits(self):
+        exits = self.candidates(self.minlat, self.maxlat, self.relfinal,
+                                exit=True)
+        if len(exits) == 0:
+            raise ChainError("No candidate exit remailers")
+        return exits
+
+    def get_nodes(self):
+        nodes = self.candidates(self.minlat, self.maxlat, self.relfinal,
+                                exit=False)
+        if len(nodes) == 0:
+            raise ChainError("No candidate remailers.")
+        return nodes
 
     def get_exit(self):
-        """Return a randomly selected exit remailer node.  The function also
-           checks if the mlist2 file has been updated since it was last
-           cached.  If it has been updated, the cache is repopulated using
-           the file content.
+        """Return a randomly selected exit remailer node.  The candidates
+           are repopulated whenever the stats or Pubring change.
         """
-        if os.path.getmtime(self.mlist2) > self.exittime:
-            log.debug("Repopulating exit remailer cache.")
-            # Stats have been updated since we last cached them.
-            exits = self.candidates(config.getint('chain', 'minlat'),
-                                    config.getint('chain', 'maxlat'),
-                                    config.getfloat('chain', 'relfinal'),
-                                    exit=True)
-            exitnum = len(exits)
-            if exitnum == 0:
-                raise ChainError("No candidate exit remailers")
-            self.exits = exits
-            self.exittime = os.path.getmtime(self.mlist2)
-        exit = self.exits[self._randint(len(self.exits) - 1)]
+        exits = self.get_exits()
+        exit = exits[Utils.randint(len(exits))]
         log.debug("Selected random exit: %s", exit)
         return exit
 
-    def shuffle_nodes(self):
-        """The Pycrypto shuffle function does an inline shuffle.  It probably
-           wouldn't hurt to do that for our purposes but I prefer to copy the
-           list, shuffle it and return the new list.
-        """
-        nodecopy = list(self.nodes)
-        Crypto.Random.random.shuffle(nodecopy)
-        return nodecopy
-
     def get_node(self):
         """As with get_exit but this function returns any candidate remailer,
            not just an exit node.
         """
-        # TODO There is a slight danger that shuffle_nodes could be called
-        # before this function has executed. This would be bad as self.nodes
-        # wouldn't be populated at that time.  Currently this cannot happen
-        # as the only call to shuffle_nodes is preceeded by a get_node call. 
-        if os.path.getmtime(self.mlist2) > self.nodetime:
-            log.debug("Repopulating remailer node cache.")
-            # Stats have been updated since we last cached them.
-            nodes = self.candidates(config.getint('chain', 'minlat'),
-                                    config.getint('chain', 'maxlat'),
-                                    config.getfloat('chain', 'relfinal'),
-                                    exit=False)
-            nodenum = len(nodes)
-            if nodenum == 0:
-                raise ChainError("No candidate remailers.")
-            self.nodes = nodes
-            self.nodetime = os.path.getmtime(self.mlist2)
-        node = self.nodes[self._randint(len(self.nodes) - 1)]
+        nodes = self.get_nodes()
+        node = nodes[Utils.randint(len(nodes))]
         log.debug("Selected random node: %s", node)
         return node
 
     def chain(self, chainstr=None):
+        """Select a chain of remailers from chainstr, where * represents a
+           random node.  The Pubring records for each node are returned, in
+           chain order, ready for encoding.
+        """
         if chainstr is None:
             # Use the configured default Chain
             chainstr = config.get('chain', 'default')
@@ -177,7 +200,7 @@ class Chain():
         if not "*" in chainlist:
             # We require no random Middleman Remailers so bail out before the
             # time consuming node selection process.
-            return chainlist
+            return self.resolve(chainlist)
         # Distance defines how close together within a chain the same node
         # can manifiest.
         distance = config.getint('chain', 'distance')
@@ -194,26 +217,22 @@ class Chain():
             if exclude_upper > chainnum:
                 exclude_upper = chainnum
             excludes = chainlist[exclude_lower:exclude_upper]
-            # Quick option first.  Grab a random Middleman.
-            new_node = self.get_node()
-            if new_node in excludes:
-                # Quick grab didn't work, the randomly selected node is in the
-                # excluded nodes list.
-                gotnode = False
-                # Shuffle the list of Middleman Remailers and then test each
-                # node in turn against the excluded nodes.  THe first node
-                # that isn't excluded will be selected.
-                nodes = self.shuffle_nodes()
-                for new_node in nodes:
-                    if new_node not in excludes:
-                        gotnode = True
-                        break
-                if not gotnode:
-                    # Every candidate Middleman is excluded.
-                    raise ChainError("Infufficient remailer pool")
+            # Select from the candidate Middlemen that aren't excluded.
+            nodes = [node for node in self.get_nodes()
+                     if node not in excludes]
+            if len(nodes) == 0:
+                # Every candidate Middleman is excluded.
+                raise ChainError("Infufficient remailer pool")
+            new_node = nodes[Utils.randint(len(nodes))]
             chainlist[n] = new_node
         log.debug("Created chain: %s", chainlist)
-        return chainlist
+        return self.resolve(chainlist)
+
+    def resolve(self, chainlist):
+        try:
+            return self.pubring.resolve(chainlist)
+        except KeyManager.PubringError, e:
+            raise ChainError(str(e))
 
 
 log = logging.getLogger("Pymaster.%s" % __name__)
@@ -227,6 +246,41 @@ if (__name__ == "__main__"):
     log.addHandler(handler)
     import KeyManager
     import time
+    import tempfile
+
+    # Remailers flagged as middlemen by an 'M' in their capstring, or as
+    # dead by a 'D' in the stats, must never be offered as exits.
+    class StubPubring():
+        generation = 1
+
+        def recache(self):
+            pass
+
+        def get_capstrings(self):
+            return {'exit': "CNm", 'middle': "CNM", 'dead': "C",
+                    'slow': "C"}
+
+    fd, mlist2 = tempfile.mkstemp()
+    f = os.fdopen(fd, 'w')
+    f.write("Generated: Tue 01 Jan 2013 00:00:00 GMT\n\n"
+            "Mixmaster    Latent-Hist   Latent  Uptime-Hist   Uptime  "
+            "Options\n" + "-" * 72 + "\n")
+    for name, hours, mins, uptime, opts in (('exit', 0, 10, 99.9, ""),
+                                            ('middle', 0, 5, 99.9, ""),
+                                            ('dead', 0, 20, 99.9, "D"),
+                                            ('slow', 2, 0, 50.0, ""),
+                                            ('nokey', 0, 1, 99.9, "")):
+        f.write("%-13s%14s%2d:%02d%17s%5.1f%%  %s\n" % (
+                name, "?" * 14, hours, mins, "", uptime, opts))
+    f.close()
+    stats = Stats(mlist2, StubPubring())
+    assert stats.candidates(0, 60, 0) == ['middle', 'exit', 'dead']
+    assert stats.candidates(0, 60, 0, exit=True) == ['exit']
+    assert stats.candidates(0, 999, 0, exit=True) == ['exit', 'slow']
+    assert stats.candidates(0, 999, 90, exit=True) == ['exit']
+    os.remove(mlist2)
+    print "Stats exit selection passed"
+
     pubring = KeyManager.Pubring()
     c = Chain(pubring)
     start = time.time()
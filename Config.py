@@ -74,6 +74,31 @@ config.set('general', 'idexp', 7)
 config.set('general', 'packetexp', 7)
 #config.set('general', 'passphrase', 'A badly configured server')
 config.set('general', 'block_first', 1)
+# Number of processes used to decrypt inbound messages.  A value of 1
+# performs all decryption within the main process.
+config.set('general', 'workers', 1)
+# Number of processes used to encode outbound packets when a pool pass has
+# several to encrypt, such as chunked randhop messages.  A value of 1
+# performs all encoding within the main process.
+config.set('general', 'encoders', 1)
+# The maximum size (in kB) a GZIP compressed payload may expand to.
+config.set('general', 'maxgzip', 4096)
+# Outbound user data of at least this many Bytes is gzip compressed when
+# doing so reduces the number of packets required.  Zero disables it.
+config.set('general', 'compress', 0)
+# Digests of received packets are retained for this period so duplicates
+# can be dropped before RSA decryption.  Max is the number of entries kept.
+config.set('general', 'digestexp', '2d')
+config.set('general', 'digestmax', 100000)
+# How often watched files (keyrings, stats and allow/block rules) are
+# checked for modification.
+config.set('general', 'filecheck', '1s')
+# The number of allow/block verdicts cached for each pair of rule files.
+config.set('general', 'rulecache', 1024)
+# When set, dest.alw and dest.blk lines of the form @domain or .domain match
+# every address at that domain or its subdomains.  Otherwise they're exact
+# matches, as are all lines in the header rule files.
+config.set('general', 'domain_rules', 'no')
 
 config.add_section('logging')
 config.set('logging', 'level', 'info')
@@ -96,6 +121,9 @@ config.set('pool', 'rate', 65)
 config.set('pool', 'indummy', 10)
 config.set('pool', 'outdummy', 90)
 config.set('pool', 'interval', '15m')
+# The number of ready-made dummy messages held for injection into the pool.
+# Zero disables the reservoir and dummies are encoded when required.
+config.set('pool', 'reservoir', 20)
 
 config.add_section('mail')
 config.set('mail', 'server', 'localhost')
@@ -189,6 +217,13 @@ makeopt('keys', 'pubkey', os.path.join(keypath, 'key.txt'))
 makeopt('keys', 'mlist2', os.path.join(keypath, 'mlist2.txt'))
 config.set('keys', 'validity_days', 372)
 config.set('keys', 'grace_days', 28)
+# A successor key is generated in the background this many days before the
+# newest Secret Key expires.
+config.set('keys', 'rotate_days', 14)
+# After a failed attempt, key generation isn't retried for this period.
+config.set('keys', 'rotate_retry', '1h')
+# Number of unknown keyids remembered by the Secring negative cache.
+config.set('keys', 'negative_cache', 1024)
 # Run Directory
 pidpath = makepath(basedir, 'run', 'run')
 makeopt('general', 'pidfile', os.path.join(pidpath, 'pymaster.pid'))
@@ -196,6 +231,8 @@ makeopt('general', 'pidfile', os.path.join(pidpath, 'pymaster.pid'))
 logpath = makepath(basedir, 'log', 'log')
 # Mixmaster Pool
 poolpath = makepath(basedir, 'pool', 'pool')
+# Reservoir of pre-encoded dummy messages
+dummypath = makepath(basedir, 'dummies', 'dummies')
 # Email options
 mailpath = makepath(basedir, 'Maildir', 'maildir')
 mkdir(os.path.join(mailpath, 'cur'))
@@ -212,6 +249,7 @@ makeopt('etc', 'adminkey', os.path.join(etcpath, 'adminkey.txt'))
 libpath = makepath(basedir, 'lib', 'lib')
 makeopt('general', 'idlog', os.path.join(libpath, 'idlog.db'))
 makeopt('general', 'explog', os.path.join(libpath, 'explog.db'))
+makeopt('general', 'digestlog', os.path.join(libpath, 'digestlog.db'))
 
 if WRITE_DEFAULT_CONFIG:
     with open('config.sample', 'w') as configfile:
@@ -20,11 +20,13 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import struct
 import sys
 import os
 import os.path
 import logging
+import re
 import zlib  # Mixmaster supports gzip payloads
 import email.message
 from Crypto.Cipher import DES3, PKCS1_v1_5
@@ -32,9 +34,12 @@ from Crypto.Hash import MD5
 from Crypto.PublicKey import RSA
 import Crypto.Random
 from Config import config
+import Armor
 import EncodePacket
 import KeyManager
+import Pool
 import Utils
+import Watcher
 import timing
 
 
@@ -46,6 +51,19 @@ class DummyMessage(Exception):
     pass
 
 
+class UnknownKeyError(ValidationError):
+    """Raised when a packet is encrypted to a key not in the Secring.  The
+    arguments are the keyid and whether it was rejected by the negative
+    cache"""
+    pass
+
+
+class OversizeError(ValidationError):
+    """Raised when a compressed payload expands beyond the configured
+    maximum size"""
+    pass
+
+
 class DestinationError(Exception):
     """Raised when a Middleman remailer doesn't explicitly accept a stated
     destination"""
@@ -53,20 +71,38 @@ class DestinationError(Exception):
 
 
 class MixPacket(object):
-    def __init__(self, destalw, destblk, headalw, headblk):
-        self.destalw = destalw
-        self.destblk = destblk
-        self.headalw = headalw
-        self.headblk = headblk
+    def __init__(self, destrules, headrules):
+        self.destrules = destrules
+        self.headrules = headrules
+        self.chunkfiles = []
+
+    def __getstate__(self):
+        """Packets are pickled when a decryption worker returns them to the
+           writer process.  The allow/block rules belong to the receiving
+           process so they're not sent along with the packet.  Buffer views
+           can't be pickled; they're recreated from the raw packet.
+        """
+        state = self.__dict__.copy()
+        for attr in ('destrules', 'headrules', 'encheads', 'encbody'):
+            if attr in state:
+                del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'raw' in state:
+            self.unpack(self.raw)
 
     def unpack(self, packet):
         """Take an encrypted Mixmaster packet and split it into its component
-           parts: The 20 headers and the payload.
+           parts: The 20 headers and the payload.  The components are read-only
+           buffers over the original packet so no data is copied.
         """
         assert len(packet) == 20480
-        fmt = '@' + ('512s' * 20)
-        self.set_encheads(struct.unpack(fmt, packet[0:10240]))
-        self.set_encbody(packet[10240:20480])
+        self.raw = packet
+        self.set_encheads(tuple([buffer(packet, h * 512, 512)
+                                 for h in range(20)]))
+        self.set_encbody(buffer(packet, 10240, 10240))
 
     def set_encheads(self, encheads):
         """A list of 20 Mixmaster encrypted headers, each of 512 Bytes.
@@ -96,9 +132,6 @@ class MixPacket(object):
         # payload, it's either corrupted or about to be corrupted.
         assert len(dbody) == 10240
         length = struct.unpack('<I', dbody[0:4])[0]
-        # We retain the length so it can be prepended to dbody again, should
-        # the message require randhopping.
-        self.length = dbody[0:4]
         self.dbody = dbody[4:length + 4]
 
     def set_chunk_dbody(self, dbody):
@@ -113,11 +146,40 @@ class MixPacket(object):
                      "a chunk message?")
         self.dbody = dbody
 
-    def append_dbody(self, dpart):
-        """This is used during chunk reassembly to concatenate message
-           components.
+    def set_chunkfiles(self, filenames):
+        """During chunk reassembly, the first chunk is held in dbody.  The
+           remaining chunks are left on disk and this list of their filenames
+           is used to stream them to the pool after the first chunk.
+        """
+        assert type(filenames) == list
+        self.chunkfiles = filenames
+
+    def join_chunks(self):
+        """Read any chunk files onto the end of dbody.  This is only done
+           when the whole message is required in memory, such as when it's
+           to be randhopped.
+        """
+        parts = [self.dbody]
+        for filename in self.chunkfiles:
+            f = open(filename, 'rb')
+            parts.append(f.read())
+            f.close()
+        self.dbody = ''.join(parts)
+        self.chunkfiles = []
+
+    def payload_blocks(self, blocksize):
+        """Yield the payload followed by the content of any chunk files, in
+           blocks of no more than blocksize Bytes.
         """
-        self.dbody += dpart
+        yield self.payload
+        for filename in self.chunkfiles:
+            f = open(filename, 'rb')
+            while True:
+                block = f.read(blocksize)
+                if not block:
+                    break
+                yield block
+            f.close()
 
     def set_dests(self, dests):
         """This is the list of up to 20 destination addresses the message may
@@ -136,27 +198,50 @@ class MixPacket(object):
         self.heads = self._head_allow(heads)
 
     def set_payload(self, payload):
-        """The actual message payload.
+        """The actual message payload.  A gzip compressed payload is retained
+           in its compressed form and only expanded as it's written to the
+           pool by write_payload.
         """
         assert type(payload) == str
-        if payload.startswith("\x1f\x8b"):
+        self.payload = payload
+        self.gzipped = payload.startswith("\x1f\x8b")
+        if self.gzipped:
             log.info("Payload begins with GZIP signature")
-            chunksize = 1024
-            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
-            length = len(payload)
-            sbyte = 0
-            outstr = ""
-            while sbyte < length:
-                ebyte = sbyte + chunksize
-                if ebyte > length:
-                    ebyte = length
-                bufstr = d.decompress(payload[sbyte:ebyte])
-                outstr += bufstr
-                sbyte = ebyte
-            outstr += d.flush()
-            self.payload = outstr
-        else:
-            self.payload = payload
+
+    def write_payload(self, f, maxsize):
+        """Write the payload, and any further chunks, to file object f.  Gzip
+           payloads are decompressed in bounded slices and an OversizeError
+           is raised if the expanded payload exceeds maxsize Bytes.
+        """
+        chunksize = 16384
+        written = 0
+        if not self.gzipped:
+            for data in self.payload_blocks(chunksize):
+                f.write(data)
+                written += len(data)
+            return written
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            for data in self.payload_blocks(chunksize):
+                # Limiting the output of each call prevents a small but
+                # highly compressed input from expanding in memory.
+                while data:
+                    bufstr = d.decompress(data, chunksize)
+                    written += len(bufstr)
+                    if written > maxsize:
+                        raise OversizeError("Decompressed payload exceeds "
+                                            "%s Bytes" % maxsize)
+                    f.write(bufstr)
+                    data = d.unconsumed_tail
+            bufstr = d.flush()
+        except zlib.error, e:
+            raise ValidationError("Corrupt GZIP payload: %s" % e)
+        written += len(bufstr)
+        if written > maxsize:
+            raise OversizeError("Decompressed payload exceeds %s Bytes"
+                                % maxsize)
+        f.write(bufstr)
+        return written
 
     def _dest_allow(self, dests):
         """Read the list of destinations defined in the message.  Strip out
@@ -165,35 +250,14 @@ class MixPacket(object):
         as a Middleman, raise a DestinationError and randhop it.
         """
         alw_dests = []
-        randhop = False
-        for d in dests:
-            alw = self.destalw.hit(d)
-            blk = self.destblk.hit(d)
-            if alw and not blk:
+        for d, verdict in zip(dests, self.destrules.decide(dests)):
+            if verdict == RuleDecisions.ALLOW:
                 alw_dests.append(d)
-            elif blk and not alw:
-                log.info("%s: Destination explicitly blocked.", d)
-            elif blk and alw:
-                # Both allow and block hits mean a decision has to be made on
-                # which has priority.  If block_first is True then allow is the
-                # second (most significant) check.  If it's False, block is
-                # more significant and the destinaion is not allowed.
-                if config.getboolean('general', 'block_first'):
-                    alw_dests.append(d)
-                else:
-                    log.info("%s: Dest matches allow and block rules but "
-                             "configuration dictates that block takes "
-                             "priority", d)
-            # Any blocked destination shouldn't reach this point.
-            elif config.getboolean('general', 'middleman') and not alw:
-                # The dest is not explicitly allowed or denied.  As this is
-                # a Middleman.
+            elif verdict == RuleDecisions.RANDHOP:
                 log.info("%s: Middleman doesn't allow this destination.", d)
                 raise DestinationError("Must randhop")
             else:
-                # No explict allow rule but we're not a Middleman so accept
-                # the stated destination.
-                alw_dests.append(d)
+                log.info("%s: Destination blocked.", d)
         return alw_dests
 
     def _head_allow(self, heads):
@@ -203,36 +267,27 @@ class MixPacket(object):
         as a Middleman, raise a DestinationError and randhop it.
         """
         alw_heads = []
-        for h in heads:
-            alw = self.headalw.hit(h)
-            blk = self.headblk.hit(h)
-            if alw and not blk:
+        for h, verdict in zip(heads, self.headrules.decide(heads)):
+            if verdict == RuleDecisions.ALLOW:
                 alw_heads.append(h)
-            elif blk and not alw:
-                log.debug("%s: Header explicitly blocked.", h)
-            elif blk and alw:
-                # Both allow and block hits mean a decision has to be made on
-                # which has priority.  If block_first is True then allow is the
-                # second (most significant) check.  If it's False, block is
-                # more significant and the destinaion is not allowed.
-                if config.getboolean('general', 'block_first'):
-                    alw_heads.append(h)
-                else:
-                    log.info("%s: Header matches allow and block rules but "
-                             "configuration dictates that block takes "
-                             "priority", h)
             else:
-                alw_heads.append(h)
+                log.debug("%s: Header blocked.", h)
         return alw_heads
 
 
 class Mixmaster():
     def __init__(self, secring, idlog, chunkmgr):
-        self.destalw = ConfFiles(config.get('etc', 'dest_alw'))
-        self.destblk = ConfFiles(config.get('etc', 'dest_blk'))
+        domains = config.getboolean('general', 'domain_rules')
+        self.destalw = ConfFiles(config.get('etc', 'dest_alw'), domains)
+        self.destblk = ConfFiles(config.get('etc', 'dest_blk'), domains)
         self.headalw = ConfFiles(config.get('etc', 'head_alw'))
         self.headblk = ConfFiles(config.get('etc', 'head_blk'))
-        self.remailer_type = "mixmaster-%s" % config.get('general', 'version')
+        # Destinations that match no rule are randhopped by a Middleman.
+        self.destrules = RuleDecisions(self.destalw, self.destblk,
+                                       config.getboolean('general',
+                                                         'middleman'))
+        self.headrules = RuleDecisions(self.headalw, self.headblk, False)
+        self.maxgzip = config.getint('general', 'maxgzip') * 1024
         self.secring = secring
         self.idlog = idlog
         self.chunkmgr = chunkmgr
@@ -245,37 +300,31 @@ class Mixmaster():
            -----END REMAILER MESSAGE-----
 
            The input to this function is a Python Email object.  That's split
-           into a list of lines and the base64 payload is extracted.  This is
-           decoded, validated by length and digest and then stored in a
-           MixPacket object.
+           into a list of lines and passed to lines2packet.
         """
-        mailmsg = msgobj.get_payload().split("\n")
-        if ("-----BEGIN REMAILER MESSAGE-----" not in mailmsg or
-            "-----END REMAILER MESSAGE-----" not in mailmsg):
-            raise ValidationError("No cutmarks on this message")
-        begin = mailmsg.index("-----BEGIN REMAILER MESSAGE-----")
-        if begin > 10:
-            # Bounces frequently contain the Remailer messages.  Checking if
-            # the cutmarks are deep in the message is a good test.
-            raise ValidationError("Cutmarks not in top ten lines of payload")
-        end = mailmsg.index("-----END REMAILER MESSAGE-----")
-        if end < begin:
-            raise ValidationError("Reversed cutmarks")
-        length = int(mailmsg[begin + 1])
-        digest = mailmsg[begin + 2].decode("base64")
-        packet = ''.join(mailmsg[begin + 3:end]).decode("base64")
-        if len(packet) != length:
-            raise ValidationError("Incorrect packet length")
-        if digest != MD5.new(data=packet).digest():
-            raise ValidationError("Mixmaster message digest failed")
+        return self.lines2packet(msgobj.get_payload().splitlines())
+
+    def lines2packet(self, lines):
+        """Take an iterable of message body lines, without line endings, and
+           return a MixPacket.
+        """
+        try:
+            packet, digest = Armor.dearmor(lines)
+        except Armor.ArmorError, e:
+            raise ValidationError(str(e))
         # This is the only place a Mixmaster Packet object is created.
-        packobj = MixPacket(self.destalw,
-                            self.destblk,
-                            self.headalw,
-                            self.headblk)
+        packobj = MixPacket(self.destrules, self.headrules)
         packobj.unpack(packet)
+        packobj.digest = digest
         return packobj
 
+    def attach_rules(self, packet):
+        """A packet received from a decryption worker arrives without any
+           allow/block rules.  Give it the ones belonging to this process.
+        """
+        packet.destrules = self.destrules
+        packet.headrules = self.headrules
+
     def packet_decrypt(self, packet):
         """Unpack a received Mixmaster email message header.  The spec calls
         for 512 Bytes, of which the last 31 are padding.
@@ -288,18 +337,22 @@ class Mixmaster():
            Padding                      [  31 bytes]
 
         """
+        # Packets encrypted to keyids we already know we don't hold are
+        # rejected before anything else is done with them.
+        keyid = packet.encheads[0][0:16].encode("hex")
+        if self.secring.unknown(keyid):
+            raise UnknownKeyError(keyid, True)
         # Unpack the header components.  This includes the 328 Byte
         # encrypted component.
-        (keyid, datalen, sesskey, iv, enc,
-         pad) = struct.unpack('@16sB128s8s328s31s', packet.encheads[0])
+        (datalen, sesskey, iv, enc,
+         pad) = struct.unpack_from('@B128s8s328s31s', packet.encheads[0], 16)
         if not len(sesskey) == datalen:
             raise ValidationError("Incorrect session key size")
-        keyid = keyid.encode("hex")
         log.debug("Message is encrypted to key: %s", keyid)
         # Use the session key to decrypt the 3DES Symmetric key
         seckey = self.secring[keyid]
         if seckey is None:
-            raise ValidationError("Secret Key not found")
+            raise UnknownKeyError(keyid, False)
         pkcs1 = PKCS1_v1_5.new(seckey)
         deskey = pkcs1.decrypt(sesskey, "Failed")
         # Process the 328 Bytes of encrypted header using our newly discovered
@@ -308,6 +361,14 @@ class Mixmaster():
         packet.set_dhead(desobj.decrypt(enc))
 
     def unpack(self, packet):
+        """Decrypt the payload of a packet and write the result to the pool.
+           This is the serial path; decryption workers call the two halves
+           independently.
+        """
+        self.decrypt_payload(packet)
+        self.write_packet(packet)
+
+    def decrypt_payload(self, packet):
         """Packet ID                            [ 16 bytes]
            Triple-DES key                       [ 24 bytes]
            Packet type identifier               [  1 byte ]
@@ -315,16 +376,17 @@ class Mixmaster():
            Timestamp                            [  7 bytes]
            Message digest                       [ 16 bytes]
            Random padding               [fill to 328 bytes]
+
+           This function has no side effects on the pool, the PacketID log
+           or the Chunk log.  It can therefore be run in a decryption worker
+           process and the resulting packet passed to write_packet.
         """
         assert len(packet.dhead) == 328
-        # Here we set up the email message object that will eventually be
-        # returned.  Regardless of the message type, the output will always
-        # be an email message.
         (packetid,
          deskey,
          packet_type) = struct.unpack("@16s24sB", packet.dhead[0:41])
-        if self.idlog.hit(packetid):
-            raise ValidationError('Known PacketID. Potential Replay-Attack.')
+        packet.packetid = packetid
+        packet.packet_type = packet_type
         if packet_type == 0:
             """Packet type 0 (intermediate hop):
                19 Initialization vectors      [152 bytes]
@@ -333,40 +395,30 @@ class Mixmaster():
             log.debug("Message is of intermediate type.")
             self.validate(packet, 273)
             fmt = "@" + ("8s" * 19)
-            ivs = struct.unpack(fmt, packet.dhead[41:193])
+            ivs = struct.unpack_from(fmt, packet.dhead, 41)
             addy = packet.dhead[193:273].rstrip("\x00")
             log.debug("Next hop is: %s", addy)
-            # The payload string will be extended as each header has a layer of
-            # encryption striped off.
-            payload = ""
+            # The packet for the next hop is assembled in a single
+            # preallocated buffer.  Each decrypted component is written
+            # straight into its slot.
+            payload = bytearray(20480)
             # Loop through two components of the message, in parallel. The IVs
             # are extracted from the encrypted packet and the corresponding
-            # encrypted header has a layer of 3DES removed.
+            # encrypted header has a layer of 3DES removed.  The body uses
+            # the same IV as the final header.  All 20 segments share one
+            # 3DES key schedule.
             assert len(ivs) == 19
             assert len(packet.encheads) == 20
-            for h in range(19):
-                # Decrypt each 512 Byte packet header using the 3DES key and a
-                # sequence of IVs held in the packet information.
-                desobj = DES3.new(deskey, DES3.MODE_CBC, IV=ivs[h])
-                payload += desobj.decrypt(packet.encheads[h + 1])
-            # At this point, the payload contains 19 headers so the length
-            # should be 19 * 512 Bytes.
-            assert len(payload) == 9728
+            segments = [(h * 512, ivs[h], packet.encheads[h + 1])
+                        for h in range(19)]
+            segments.append((10240, ivs[18], packet.encbody))
+            Utils.MultiCBC(deskey).decrypt_into(payload, segments)
             # Add a fake 512 byte header to the bottom of the header stack.
             # This replaces the first header that we removed.
-            payload += Crypto.Random.get_random_bytes(512)
-            assert len(payload) == 10240
-            desobj = DES3.new(deskey, DES3.MODE_CBC, IV=ivs[18])
-            payload += desobj.decrypt(packet.encbody)
+            payload[9728:10240] = Utils.randbytes(512)
             assert len(payload) == 20480
-            # This email object will be populated with the message for the
-            # next hop remailer.
-            msg = email.message.Message()
-            msg.set_payload(self.mixprep(payload))
-            msg['To'] = addy
-            f = open(Utils.pool_filename('m'), 'w')
-            f.write(msg.as_string())
-            f.close()
+            packet.nextaddy = addy
+            packet.nextpacket = payload
         elif packet_type == 1:
             """Packet type 1 (final hop):
                Message ID                     [ 16 bytes]
@@ -377,20 +429,6 @@ class Mixmaster():
             message_id, iv = struct.unpack("@16s8s", packet.dhead[41:65])
             desobj = DES3.new(deskey, DES3.MODE_CBC, IV=iv)
             packet.set_dbody(desobj.decrypt(packet.encbody))
-            self.unpack_body(packet)
-            # This email object will be populated with the message for the
-            # final destination.
-            msg = email.message.Message()
-            msg.set_payload(packet.payload)
-            # This may require a little refinement but for now it seems to
-            # fit the requirements.
-            msg['To'] = ','.join(packet.dests)
-            for h in packet.heads:
-                head, content = h.split(':', 1)
-                msg[head.strip()] = content.strip()
-            f = open(Utils.pool_filename('m'), 'w')
-            f.write(msg.as_string())
-            f.close()
         elif packet_type == 2:
             """Packet type 2 (final hop, partial message):
                Chunk number                   [  1 byte ]
@@ -404,30 +442,73 @@ class Mixmaster():
              iv) = struct.unpack('@BB16s8s', packet.dhead[41:67])
             desobj = DES3.new(deskey, DES3.MODE_CBC, IV=iv)
             packet.set_dbody(desobj.decrypt(packet.encbody))
-            ready_to_send = self.chunkmgr.bucket(message_id, numchunks,
-                                                 chunknum, packet)
+            packet.chunknum = chunknum
+            packet.numchunks = numchunks
+            packet.messageid = message_id
+        else:
+            raise ValidationError("Unknown packet type: %s" % packet_type)
+
+    def write_packet(self, packet):
+        """Take a packet that has been through decrypt_payload and write the
+           outcome to the pool.  The PacketID and Chunk logs are only touched
+           here, so only one process (the writer) may call this function.
+        """
+        if self.idlog.hit(packet.packetid):
+            raise ValidationError('Known PacketID. Potential Replay-Attack.')
+        if packet.packet_type == 0:
+            # The packet for the next hop remailer is pooled in binary and
+            # armored when it's sent.
+            Pool.write_packet(packet.nextaddy, packet.nextpacket)
+        elif packet.packet_type == 1:
+            self.unpack_body(packet)
+            self.write_exit(packet)
+        elif packet.packet_type == 2:
+            message_id = packet.messageid
+            ready_to_send = self.chunkmgr.bucket(message_id, packet.numchunks,
+                                                 packet.chunknum, packet)
             if ready_to_send:
                 # It's message reconstruction time!  First we need to retrieve
-                # the first chunk; it contains the headers.
+                # the first chunk; it contains the headers.  The other chunks
+                # are streamed from disk by write_exit.
                 self.chunkmgr.assemble(message_id, packet)
-                self.unpack_body(packet)
-                # The message object is now constructed from the first chunk.
-                msg = email.message.Message()
-                msg.set_payload(packet.payload)
-                # This may require a little refinement but for now it seems to
-                # fit the requirements.
-                msg['To'] = ','.join(packet.dests)
-                for h in packet.heads:
-                    head, content = h.split(':', 1)
-                    msg[head.strip()] = content.strip()
-                # The message is now written to the file in the usual manner,
-                # except that before closing it, we append all the other
-                # message chunks to it in sequence.  This approach saves
-                # reading the potentially ~2.5MB payload into memory.
-                f = open(Utils.pool_filename('m'), 'w')
-                f.write(msg.as_string())
-                f.close()
-                self.chunkmgr.delete(message_id)
+                try:
+                    try:
+                        self.unpack_body(packet)
+                    except DestinationError:
+                        # The whole message is randhopped so the chunks have
+                        # to be read before they're deleted.
+                        packet.join_chunks()
+                        raise
+                    self.write_exit(packet)
+                finally:
+                    # Whether it was written, randhopped or rejected, the
+                    # chunks are no longer required.
+                    self.chunkmgr.delete(message_id)
+
+    def write_exit(self, packet):
+        """Write an exit message to a new pool file.  The headers are
+           written first and the payload is then streamed after them.  If the
+           payload is rejected, the partial pool file is removed.
+        """
+        # This email object contains just the headers for the final
+        # destination.
+        msg = email.message.Message()
+        # This may require a little refinement but for now it seems to
+        # fit the requirements.
+        msg['To'] = ','.join(packet.dests)
+        for h in packet.heads:
+            head, content = h.split(':', 1)
+            msg[head.strip()] = content.strip()
+        filename = Utils.pool_filename('m')
+        f = open(filename, 'w')
+        try:
+            f.write(msg.as_string())
+            packet.write_payload(f, self.maxgzip)
+        except ValidationError:
+            f.close()
+            os.remove(filename)
+            raise
+        f.close()
 
     def unpack_body(self, packet):
         """Length                         [       4 bytes]
@@ -501,57 +582,191 @@ class Mixmaster():
             padded[e] = padded[e].rstrip("\x00")
         return padded
 
-    def mixprep(self, binary):
-        """Take a binary string, encode it as Base64 and wrap it to lines of
-           length n.
-        """
-        # This is the wrap width for Mixmaster Base64
-        n = 40
-        checksum = MD5.new(data=binary).digest().encode("base64")
-        length = len(binary)
-        s = binary.encode("base64")
-        s = ''.join(s.split("\n"))
-        header = "::\n"
-        header += "Remailer-Type: %s\n\n" % self.remailer_type
-        header += "-----BEGIN REMAILER MESSAGE-----\n"
-        header += "%s\n" % length
-        header += "%s\n" % checksum
-        payload = ""
-        while len(s) > 0:
-            payload += s[:n] + "\n"
-            s = s[n:]
-        payload = header + payload
-        payload += "-----END REMAILER MESSAGE-----\n"
-        return payload
-
 
 class ConfFiles():
-    def __init__(self, filename):
-        # mtime is set to the Modified date on the file in "since Epoch"
-        # format.  Setting it to zero ensures the file i`s read on the first
-        # pass.
-        mtime = 0
-        self.mtime = mtime
+    """A set of allow or block rules, compiled from a file.  Each line of the
+       file is one of:
+           /regex/      A regular expression.  All of these are combined
+                        into a single expression.
+           @domain      When domains is True, matches any address at domain
+                        or its subdomains.  Otherwise an exact match.
+           .domain      As above.
+           anything     An exact match.
+    """
+    def __init__(self, filename, domains=False):
         self.filename = filename
+        self.domains = domains
+        # The Watcher generation of the file when it was last compiled.
+        # Generations start at one so the file is read on the first pass.
+        self.filegen = 0
+        self.exact_rules = set()
+        self.domain_rules = {}
+        self.regex_rules = False
+        # Incremented each time the rules are compiled so that anything
+        # derived from them knows when it's stale.
+        self.generation = 0
         log.info("%s: Initialized" % filename)
 
-    def hit(self, testdata):
-        if not os.path.isfile(self.filename):
-            return False
-        file_modified = os.path.getmtime(self.filename)
-        if file_modified > self.mtime:
+    def recache(self):
+        """Recompile the rules if the file has been modified since they were
+           last compiled.
+        """
+        filegen = Watcher.generation(self.filename)
+        if filegen == self.filegen:
+            return
+        self.filegen = filegen
+        if os.path.isfile(self.filename):
             log.info("%s modified. Recreating rules.", self.filename)
-            (self.regex_rules,
-             self.list_rules) = Utils.file2regex(self.filename)
-            self.mtime = file_modified
-        if testdata in self.list_rules:
-            return True
-        if self.regex_rules:
-            regex_test = self.regex_rules.search(testdata)
-            if regex_test:
+            self.compile(Utils.file2list(self.filename))
+        else:
+            # A missing file has no rules.
+            self.compile([])
+
+    def compile(self, lines):
+        exact = set()
+        domains = {}
+        reglines = []
+        for line in lines:
+            if len(line) > 1 and line.startswith("/") and line.endswith("/"):
+                reglines.append(line[1:-1])
+            elif self.domains and (line.startswith("@") or
+                                   line.startswith(".")):
+                # Domains are stored in a trie keyed by reversed labels.
+                # A key of None marks the end of a blocked domain.
+                node = domains
+                for label in reversed(line[1:].lower().split(".")):
+                    node = node.setdefault(label, {})
+                node[None] = True
+            else:
+                exact.add(line.rstrip())
+        if len(reglines) == 0:
+            # No valid regex entires exist in the file.
+            compiled = False
+        else:
+            regex = '|'.join(reglines)
+            # This should never happen but best to check as || will match
+            # everything.
+            regex = regex.replace('||', '|')
+            compiled = re.compile(regex)
+        self.exact_rules = exact
+        self.domain_rules = domains
+        self.regex_rules = compiled
+        self.generation += 1
+
+    def domain_hit(self, testdata):
+        """Walk the domain trie from the top level label down.  Any
+           terminating node along the way is a match.
+        """
+        node = self.domain_rules
+        domain = testdata.rsplit("@", 1)[-1].lower()
+        for label in reversed(domain.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
                 return True
         return False
 
+    def hits(self, items):
+        """Return a list of booleans indicating which of the given items
+           match a rule.
+        """
+        self.recache()
+        results = []
+        for testdata in items:
+            if testdata in self.exact_rules:
+                results.append(True)
+            elif self.domain_rules and self.domain_hit(testdata):
+                results.append(True)
+            elif self.regex_rules and self.regex_rules.search(testdata):
+                results.append(True)
+            else:
+                results.append(False)
+        return results
+
+    def hit(self, testdata):
+        return self.hits([testdata])[0]
+
+
+class RuleDecisions():
+    """The combined verdict of an allow and a block rule file.  The same
+       destinations and headers turn up in message after message so verdicts
+       are held in an LRU cache.  The cache is emptied whenever either file
+       is recompiled.
+    """
+    ALLOW = 0
+    BLOCK = 1
+    RANDHOP = 2
+
+    def __init__(self, allow, block, randhop):
+        self.allow = allow
+        self.block = block
+        # When True, items that match no rule are randhopped instead of
+        # being allowed.
+        self.randhop = randhop
+        self.block_first = config.getboolean('general', 'block_first')
+        self.maxsize = config.getint('general', 'rulecache')
+        self.cache = collections.OrderedDict()
+        self.generation = (allow.generation, block.generation)
+        self.lookups = 0
+        self.cache_hits = 0
+
+    def verdict(self, alw, blk):
+        if alw and not blk:
+            return self.ALLOW
+        if blk and not alw:
+            return self.BLOCK
+        if blk and alw:
+            # Both allow and block hits mean a decision has to be made on
+            # which has priority.  If block_first is True then allow is the
+            # second (most significant) check.  If it's False, block is
+            # more significant and the item is not allowed.
+            if self.block_first:
+                return self.ALLOW
+            return self.BLOCK
+        if self.randhop:
+            return self.RANDHOP
+        return self.ALLOW
+
+    def decide(self, items):
+        """Return a list of verdicts for the given items.  Only those not
+           already cached are tested against the rules.
+        """
+        self.allow.recache()
+        self.block.recache()
+        generation = (self.allow.generation, self.block.generation)
+        if generation != self.generation:
+            self.cache.clear()
+            self.generation = generation
+        self.lookups += len(items)
+        verdicts = []
+        misses = []
+        for item in items:
+            verdict = self.cache.pop(item, None)
+            if verdict is None:
+                misses.append(item)
+            else:
+                self.cache_hits += 1
+                self.cache[item] = verdict
+            verdicts.append(verdict)
+        if misses:
+            decided = {}
+            alws = self.allow.hits(misses)
+            blks = self.block.hits(misses)
+            for item, alw, blk in zip(misses, alws, blks):
+                decided[item] = self.verdict(alw, blk)
+                self.cache[item] = decided[item]
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+            verdicts = [decided[item] if verdict is None else verdict
+                        for item, verdict in zip(items, verdicts)]
+        return verdicts
+
+    def hit_ratio(self):
+        if self.lookups == 0:
+            return 0.0
+        return float(self.cache_hits) / self.lookups
+
 
 log = logging.getLogger("Pymaster.%s" % __name__)
 if (__name__ == "__main__"):
@@ -563,3 +778,178 @@ if (__name__ == "__main__"):
     handler.setFormatter(logging.Formatter(fmt=logfmt, datefmt=datefmt))
     log.addHandler(handler)
     secring = KeyManager.Secring()
+
+    # Benchmark the peeling of an intermediate packet.  The legacy method
+    # sliced the packet into strings and concatenated the decrypted parts;
+    # the current one decrypts from views into a preallocated buffer.
+    import time
+    iterations = 500
+    inner = EncodePacket.InnerHeader({'nextaddy': 'bench@domain.invalid'}, 0)
+    packet = MixPacket(None, None)
+    packet.unpack(Crypto.Random.get_random_bytes(20480))
+    packet.set_dhead(inner.make_header())
+    decode = Mixmaster(secring, None, None)
+
+    class Tally():
+        """The bytes produced by operations that copy packet data."""
+        def __init__(self):
+            self.bytes = 0
+
+        def add(self, data):
+            self.bytes += len(data)
+            return data
+
+    tally = Tally()
+
+    def legacy_peel(packet):
+        # Every string the legacy method creates passes through the tally.
+        encheads = [tally.add(h) for h in
+                    struct.unpack('@' + ('512s' * 20), packet.raw[0:10240])]
+        encbody = tally.add(packet.raw[10240:20480])
+        deskey = tally.add(packet.dhead[16:40])
+        ivs = [tally.add(iv) for iv in
+               struct.unpack("@" + ("8s" * 19), packet.dhead[41:193])]
+        payload = ""
+        for h in range(19):
+            desobj = DES3.new(deskey, DES3.MODE_CBC, IV=ivs[h])
+            payload = tally.add(payload +
+                                tally.add(desobj.decrypt(encheads[h + 1])))
+        payload = tally.add(payload +
+                            tally.add(Crypto.Random.get_random_bytes(512)))
+        desobj = DES3.new(deskey, DES3.MODE_CBC, IV=ivs[18])
+        payload = tally.add(payload + tally.add(desobj.decrypt(encbody)))
+        return payload
+
+    # The current method is measured by substituting counting versions of
+    # the cipher, struct, RNG and buffer it uses to copy packet data.
+    class CountingCipher():
+        def __init__(self, cipher):
+            self.cipher = cipher
+
+        def decrypt(self, data):
+            return tally.add(self.cipher.decrypt(data))
+
+    class CountingDES3():
+        MODE_CBC = DES3.MODE_CBC
+
+        def new(self, *args, **kwargs):
+            return CountingCipher(DES3.new(*args, **kwargs))
+
+    class CountingStruct():
+        def __init__(self, module):
+            self.module = module
+
+        def unpack(self, fmt, data):
+            return self.count(self.module.unpack(fmt, data))
+
+        def unpack_from(self, fmt, data, offset=0):
+            return self.count(self.module.unpack_from(fmt, data, offset))
+
+        def count(self, values):
+            for value in values:
+                if isinstance(value, str):
+                    tally.add(value)
+            return values
+
+    class CountingBuffer(bytearray):
+        def __init__(self, *args):
+            super(CountingBuffer, self).__init__(*args)
+            tally.add(self)
+
+        def __setitem__(self, key, value):
+            if not isinstance(value, int):
+                tally.add(value)
+            super(CountingBuffer, self).__setitem__(key, value)
+
+    def current_peel(packet):
+        originals = (struct, Utils.DES3, Utils.randbytes)
+        randbytes = Utils.randbytes
+        globals()['struct'] = CountingStruct(struct)
+        globals()['bytearray'] = CountingBuffer
+        Utils.DES3 = CountingDES3()
+        Utils.randbytes = lambda n: tally.add(randbytes(n))
+        try:
+            decode.decrypt_payload(packet)
+        finally:
+            globals()['struct'], Utils.DES3, Utils.randbytes = originals
+            del globals()['bytearray']
+
+    copies = []
+    for peel in (legacy_peel, current_peel):
+        tally.bytes = 0
+        peel(packet)
+        copies.append(tally.bytes)
+    assert str(packet.nextpacket[0:9728]) == legacy_peel(packet)[0:9728]
+    start = time.time()
+    for n in range(iterations):
+        legacy_peel(packet)
+    legacy_time = (time.time() - start) / iterations
+    start = time.time()
+    for n in range(iterations):
+        decode.decrypt_payload(packet)
+    current_time = (time.time() - start) / iterations
+    print "Legacy:  %s bytes copied, %.1f usecs per packet" % (
+          copies[0], legacy_time * 1000000)
+    print "Current: %s bytes copied, %.1f usecs per packet" % (
+          copies[1], current_time * 1000000)
+
+    # Benchmark the rejection cost of inbound messages.  The legacy parser
+    # read every message into an email object and split the whole body
+    # before looking for cutmarks.  The current one streams the body and
+    # stops as soon as a message is known to be invalid.
+    import StringIO
+    armored = Armor.armor(Crypto.Random.get_random_bytes(20480))
+    # Strip the Remailer-Type pseudo-header, leaving the cutmark block.
+    armored = armored.split("\n", 3)[3]
+    junk = "".join(["This is line %s of some junk mail.\n" % n
+                    for n in range(500)])
+    armlines = armored.split("\n")
+    armlines[2] = MD5.new(data="wrong").digest().encode("base64").rstrip()
+    corpus = {'valid': armored,
+              'junk': junk,
+              'bounce': junk[:2000] + armored,
+              'truncated': armored[:10000],
+              'digest': "\n".join(armlines)}
+
+    def legacy_email2packet(msgobj):
+        mailmsg = msgobj.get_payload().split("\n")
+        if ("-----BEGIN REMAILER MESSAGE-----" not in mailmsg or
+            "-----END REMAILER MESSAGE-----" not in mailmsg):
+            raise ValidationError("No cutmarks on this message")
+        begin = mailmsg.index("-----BEGIN REMAILER MESSAGE-----")
+        if begin > 10:
+            raise ValidationError("Cutmarks not in top ten lines of payload")
+        end = mailmsg.index("-----END REMAILER MESSAGE-----")
+        if end < begin:
+            raise ValidationError("Reversed cutmarks")
+        length = int(mailmsg[begin + 1])
+        digest = mailmsg[begin + 2].decode("base64")
+        packet = ''.join(mailmsg[begin + 3:end]).decode("base64")
+        if len(packet) != length:
+            raise ValidationError("Incorrect packet length")
+        if digest != MD5.new(data=packet).digest():
+            raise ValidationError("Mixmaster message digest failed")
+
+    print "%-10s %12s %12s" % ("Message", "Legacy", "Streaming")
+    for name in ('valid', 'junk', 'bounce', 'truncated', 'digest'):
+        text = "To: bench@domain.invalid\n\n" + corpus[name]
+        start = time.time()
+        for n in range(iterations):
+            try:
+                legacy_email2packet(email.message_from_string(text))
+            except ValidationError:
+                pass
+        legacy_time = (time.time() - start) / iterations
+        start = time.time()
+        for n in range(iterations):
+            lines = Utils.readlines(StringIO.StringIO(text))
+            for line in lines:
+                if len(line) == 0:
+                    break
+            try:
+                decode.lines2packet(lines)
+            except ValidationError:
+                pass
+        current_time = (time.time() - start) / iterations
+        print "%-10s %7.1f usec %7.1f usec" % (name, legacy_time * 1000000,
+                                               current_time * 1000000)
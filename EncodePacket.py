@@ -23,17 +23,23 @@
 import struct
 import sys
 import logging
-from Crypto.Cipher import DES3, PKCS1_v1_5
+import multiprocessing
+import zlib
+from Crypto.Cipher import DES3
 from Crypto.Hash import MD5
 from Crypto.PublicKey import RSA
 import Crypto.Random
 from Config import config
+import Armor
 import timing
 import Chain
 import email.message
 import KeyManager
 import Utils
 
+# The fewest jobs that encode_jobs will spread across worker processes.
+PARALLEL_JOBS = 4
+
 
 class EncodeError(Exception):
     pass
@@ -50,7 +56,7 @@ class PacketInfo():
            Remailer address               [ 80 bytes]
         """
         # 152 Random bytes equates to 19 IVs of 8 Bytes each.
-        ivstr = Crypto.Random.get_random_bytes(152)
+        ivstr = Utils.randbytes(152)
         fmt = "8s" * 19
         ivs = struct.unpack(fmt, ivstr)
         # The address of the next hop needs to be padded to 80 Chars
@@ -64,8 +70,8 @@ class PacketInfo():
            Message ID                     [ 16 bytes]
            Initialization vector          [  8 bytes]
         """
-        messageid = Crypto.Random.get_random_bytes(16)
-        iv = Crypto.Random.get_random_bytes(8)
+        messageid = Utils.randbytes(16)
+        iv = Utils.randbytes(8)
         self.messageid = messageid
         self.iv = iv
         return struct.pack('@16s8s', messageid, iv)
@@ -80,8 +86,8 @@ class PacketInfo():
         self.chunknum = chunknum
         self.numchunks = numchunks
         self.messageid = mid
-        self.iv = Crypto.Random.get_random_bytes(8)
-        return struct.pack('@BB16s8s', chunknum, numchunks, mid, iv)
+        self.iv = Utils.randbytes(8)
+        return struct.pack('@BB16s8s', chunknum, numchunks, mid, self.iv)
 
 
 class InnerHeader():
@@ -99,15 +105,17 @@ class InnerHeader():
            Message digest                       [ 16 bytes]
            Random padding               [fill to 328 bytes]
         """
-        packetid = Crypto.Random.get_random_bytes(16)
-        des3key = Crypto.Random.get_random_bytes(24)
+        packetid = Utils.randbytes(16)
+        des3key = Utils.randbytes(24)
         timestamp = "0000\x00" + struct.pack('<H', timing.epoch_days())
         if self.msgtype == 0:
             pktinfo = self.pktinfo.intermediate_hop(self.rem_data['nextaddy'])
         elif self.msgtype == 1:
             pktinfo = self.pktinfo.final_hop()
         elif self.msgtype == 2:
-            pktinfo = self.pktinfo.final_partial()
+            pktinfo = self.pktinfo.final_partial(self.rem_data['chunknum'],
+                                                 self.rem_data['numchunks'],
+                                                 self.rem_data['messageid'])
         pktlen = len(pktinfo)
         fmt = "@16s24sB%ss7s" % len(pktinfo)
         header = struct.pack(fmt,
@@ -128,7 +136,7 @@ class InnerHeader():
             raise EncodeError("Unknown message type")
         pad = 328 - len(header)
         self.des3key = des3key
-        return header + Crypto.Random.get_random_bytes(pad)
+        return header + Utils.randbytes(pad)
 
 
 class OuterHeader():
@@ -148,11 +156,10 @@ class OuterHeader():
         # This 3DES key and IV are only used to encrypt the 328 Byte Inner
         # Header.  The 3DES key is then RSA Encrypted using the Remailer's
         # Public key.
-        des3key = Crypto.Random.get_random_bytes(24)
-        iv = Crypto.Random.get_random_bytes(8)
+        des3key = Utils.randbytes(24)
+        iv = Utils.randbytes(8)
         desobj = DES3.new(des3key, DES3.MODE_CBC, IV=iv)
-        pkcs1 = PKCS1_v1_5.new(self.rem_data['keyobj'])
-        rsakey = pkcs1.encrypt(des3key)
+        rsakey = self.rem_data['cipher'].encrypt(des3key)
         # Why does Mixmaster record the RSA data length when the spec
         # allows for nothing but 1024 bit keys?
         lenrsa = len(rsakey)
@@ -163,7 +170,7 @@ class OuterHeader():
                             rsakey,
                             iv,
                             desobj.encrypt(self.inner.make_header()),
-                            Crypto.Random.get_random_bytes(31))
+                            Utils.randbytes(31))
         assert len(header) == 512
         return header
 
@@ -172,8 +179,9 @@ class Payload():
     """This class takes a Python email.message object and translates it into
        a Mixmaster payload.  The resulting payload is stored as self.dbody
        (decrytped body) as this matches the format used during Decode
-       processing.  This means randhops can be processed without having to
-       pass huge lumps of scalars for re-encoding to a random exit.
+       processing; it has no length field or padding.  This means randhops
+       can be processed without having to pass huge lumps of scalars for
+       re-encoding to a random exit.
     """
     def __init__(self, msgobj):
         self.msgobj = msgobj
@@ -189,12 +197,10 @@ class Payload():
             if not k == 'Dests':
                 heads.append("%s: %s" % (k, self.msgobj[k]))
         payload += self.encode_header(heads)
-        payload += self.msgobj.get_payload()
-        length = struct.pack('<I', len(payload))
-        payload = length + payload
-        payload += Crypto.Random.get_random_bytes(10240 - len(payload))
+        if self.msgobj.is_multipart():
+            raise EncodeError("Multipart messages are not supported")
         # dbody is the scalar expected withih the object passed to makemsg
-        self.dbody = payload
+        self.dbody = compress(payload, self.msgobj.get_payload())
 
     def encode_header(self, items):
         """This function takes a list of destinations or headers and converts
@@ -204,79 +210,218 @@ class Payload():
                 Number of header line fields   [        1 byte]
                 Header lines fields            [ 80 bytes each]
         """
+        if len(items) > 20:
+            raise EncodeError("More than 20 destination or header fields")
         # The return string begins with the single-Byte count of the fields.
         headstr = struct.pack('B', len(items))
         for item in items:
             item = item.strip()
             padlen = 80 - len(item)
+            if padlen < 0:
+                raise EncodeError("Field exceeds 80 characters: %s" % item)
             headstr += item + ("\x00" * padlen)
         return headstr
 
 
+class PacketBody():
+    """A single outbound packet.  Encoding starts with a padded 10240 Byte
+       dbody and adds the headers, the complete payload and the address of
+       the first hop.
+    """
+    def __init__(self, dbody):
+        assert len(dbody) == 10240
+        self.dbody = dbody
+
+
 class Mixmaster(object):
     def __init__(self, pubring):
         self.pubring = pubring
         self.chain = Chain.Chain(pubring)
+        self.workers = config.getint('general', 'encoders')
 
     def dummy(self):
         try:
-            node = self.chain.get_node()
+            msgs = self.dummy_msgs()
         except Chain.ChainError, e:
             log.warn("Dummy sending failed: %s", e)
             return 0
+        self.write_pool(msgs)
+
+    def dummy_msgs(self):
+        """Encode a dummy message to a random node and return it as a list
+           of email messages, in the same manner as makemsg.
+        """
+        node = self.chain.get_node()
         msg = email.message.Message()
-        # payload size is arbitrary as the payload class pads it with random
-        # data to a length of 10240.
-        msg.set_payload(Crypto.Random.get_random_bytes(10))
+        # payload size is arbitrary as makemsg pads it with random data to a
+        # length of 10240.
+        msg.set_payload(Utils.randbytes(10))
         msg['Dests'] = 'null:'
         # The payload object created here will be extended by the various
         # fuctions that tweak the message into the final format for pool
         # injection.
         packet = Payload(msg)
-        # email2payload compiles the Mixmaster payload; the second 10240 Bytes
-        # of the overall Mixmaster packet.  This is stored in packet.dbody.
+        # email2payload compiles the Mixmaster payload; the content of the
+        # second 10240 Bytes of the overall Mixmaster packet.  This is stored
+        # in packet.dbody.
         packet.email2payload()
-        outmsg = self.makemsg(packet, node)
-        f = open(Utils.pool_filename('m'), 'w')
-        f.write(outmsg.as_string())
-        f.close()
-
-    def randhop(self, packet):
-        """Randhop is passed the decrypted message packet object that includes
-           a dbody (decrypted body) scalar.  This is the only part needed for
-           randhopping.
+        return self.makemsg(packet, node)
+
+    def randhop_jobs(self, dbody):
+        """Randhop is passed the decrypted body (dbody) of a message.  This
+           is the only part needed for randhopping.  Chunked messages arrive
+           with every chunk joined into dbody and are chunked again here.
+           The encoding jobs are returned so that the randhops from one pool
+           pass can be encrypted together by encode_jobs.
         """
         exitnode = self.chain.get_exit()
-        # Reappend the length to the decrypted body. Setting dbody during
-        # decoding removed this info.  It also stripped the random padding
-        # so that gets reversed here too.
-        packet.dbody = packet.length + packet.dbody
-        length = len(packet.dbody)
-        packet.dbody += Crypto.Random.get_random_bytes(10240 - length)
-        msg = self.makemsg(packet, chainstr=exitnode)
-        f = open(Utils.pool_filename('m'), 'w')
-        f.write(msg.as_string())
-        f.close()
+        # Split the destination and header fields from the user data so the
+        # latter can be compressed.
+        dfields = ord(dbody[0])
+        hfields = ord(dbody[1 + 80 * dfields])
+        headlen = 2 + 80 * (dfields + hfields)
+        dbody = compress(dbody[:headlen], dbody[headlen:])
+        return self.packet_jobs(dbody, exitnode)
+
+    def write_pool(self, msgs, path=None):
+        """Write each message to a new pool file.  Path overrides the
+           configured pool directory.
+        """
+        for msg in msgs:
+            f = open(Utils.pool_filename('m', path), 'w')
+            f.write(msg.as_string())
+            f.close()
 
     def makemsg(self, packet, chainstr=None):
+        """Encode the dbody of packet and return a list of email messages,
+           one for each Mixmaster packet.  Anything larger than a single
+           packet is sent as a chunked message.
+        """
+        return self.encode_jobs(self.packet_jobs(packet.dbody, chainstr))
+
+    def makemsgs(self, msgobjs, chainstr=None):
+        """Encode a batch of email messages.  The chains for every packet of
+           every message are selected first and the packets are then
+           encrypted together.  Returns a list, in the same order as
+           msgobjs, of the encoded messages for each or None where a message
+           couldn't be encoded.  A Chain header on a message overrides
+           chainstr.
+        """
+        jobs = []
+        counts = []
+        for msgobj in msgobjs:
+            try:
+                msgchain = chainstr
+                if 'Chain' in msgobj:
+                    msgchain = msgobj['Chain']
+                    del msgobj['Chain']
+                payload = Payload(msgobj)
+                payload.email2payload()
+                msgjobs = self.packet_jobs(payload.dbody, msgchain)
+            except (EncodeError, Chain.ChainError), e:
+                log.warn("Message not encoded: %s", e)
+                counts.append(None)
+                continue
+            counts.append(len(msgjobs))
+            jobs.extend(msgjobs)
+        encoded = iter(self.encode_jobs(jobs))
+        results = []
+        for count in counts:
+            if count is None:
+                results.append(None)
+            else:
+                results.append([encoded.next() for n in range(count)])
+        return results
+
+    def pad(self, data):
+        """Length                         [       4 bytes]
+           Data                           [up to 10236 bytes]
+           Random padding                 [fill to 10240 bytes]
+        """
+        assert len(data) <= 10236
+        return (struct.pack('<I', len(data)) + data +
+                Utils.randbytes(10236 - len(data)))
+
+    def packet_jobs(self, data, chainstr=None):
+        """Select the chains for data and return a list of encoding jobs,
+           one per packet, for encode_jobs.  Data that exceeds a single
+           packet is split into chunk (packet type 2) jobs.  Every chunk must
+           reach the same exit remailer so it can be reassembled there.  The
+           rest of each chain is selected independently.
+        """
         if chainstr is None:
-            chain = self.chain.chain()
-        else:
-            chain = self.chain.chain(chainstr)
-        if len(packet.dbody) <= 10240:
-            self.final_hop(packet, chain)
-        else:
-            #TODO We don't yet handle chunk message creation
-            pass
+            chainstr = config.get('chain', 'default')
+        if len(data) <= 10236:
+            return [(self.pad(data), self.chain.chain(chainstr), None)]
+        numchunks = (len(data) + 10235) // 10236
+        if numchunks > 255:
+            raise EncodeError("Message of %s Bytes exceeds the 255 chunk "
+                              "limit" % len(data))
+        messageid = Utils.randbytes(16)
+        chainlist = [c.strip() for c in chainstr.split(",")]
+        if chainlist[-1] == "*":
+            chainlist[-1] = self.chain.get_exit()
+        chainstr = ",".join(chainlist)
+        log.debug("Encoding %s Byte message as %s chunks to exit %s",
+                  len(data), numchunks, chainlist[-1])
+        jobs = []
+        for n in range(numchunks):
+            dbody = self.pad(data[n * 10236:(n + 1) * 10236])
+            chunk = (n + 1, numchunks, messageid)
+            jobs.append((dbody, self.chain.chain(chainstr), chunk))
+        return jobs
+
+    def encode_jobs(self, jobs):
+        """Encrypt a list of jobs from packet_jobs and return the resulting
+           email messages in the same order.  When configured, batches of at
+           least PARALLEL_JOBS jobs are spread across a pool of worker
+           processes.  Smaller batches don't repay the cost of forking.
+        """
+        if self.workers < 2 or len(jobs) < PARALLEL_JOBS:
+            return [self.encode_packet(*job) for job in jobs]
+        # The workers inherit the jobs when they're forked; only an index
+        # is passed to them.  Chain records contain cipher objects that
+        # can't be pickled.
+        global _worker_encode, _worker_jobs
+        _worker_encode = self
+        _worker_jobs = jobs
+        procs = min(self.workers, len(jobs))
+        workers = multiprocessing.Pool(procs, initializer=Utils.child_init)
+        try:
+            msgs = workers.map(_encode_worker, range(len(jobs)))
+        except:
+            workers.terminate()
+            workers.join()
+            raise
+        workers.close()
+        workers.join()
+        return msgs
+
+    def encode_packet(self, dbody, chain, chunk=None):
+        """Encrypt a padded 10240 Byte body through the given chain of
+           Pubring records and return the email message for the first hop.
+           The chain list is consumed.  Chunk is either None
+           or a tuple of (chunknum, numchunks, messageid).
+        """
+        packet = PacketBody(dbody)
+        self.final_hop(packet, chain, chunk)
         return self.packet2mail(packet)
 
-    def final_hop(self, packet, chain):
+    def final_hop(self, packet, chain, chunk=None):
         # packet must be an object with a dbody scalar.
         assert hasattr(packet, "dbody")
         # The last node in the chain is the final hop.
-        node = chain.pop()
-        rem_data = self.nodedata(name=node)
-        outer = OuterHeader(rem_data, 1)
+        rem_data = chain.pop()
+        if chunk is None:
+            outer = OuterHeader(rem_data, 1)
+        else:
+            # Copy the node data so the chunk details don't end up in the
+            # Pubring.
+            rem_data = dict(rem_data)
+            (rem_data['chunknum'],
+             rem_data['numchunks'],
+             rem_data['messageid']) = chunk
+            outer = OuterHeader(rem_data, 2)
         # This is always the first header so it creates the list of headers.
         headers = [outer.make_header()]
         desobj = DES3.new(outer.inner.des3key,
@@ -301,28 +446,24 @@ class Mixmaster(object):
         assert len(packet.headers) == 1
         while len(chain) > 0:
             numheads = len(packet.headers)
-            thishop = chain.pop()
-            rem_data = self.nodedata(name=thishop)
-            # This uses the rem_data dict to pass the next hop address
-            # to the pktinfo section of Intermediate messages.
-            rem_data['nextaddy'] = packet.nextaddy
+            # This uses a copy of the rem_data dict to pass the next hop
+            # address to the pktinfo section of Intermediate messages.
+            rem_data = dict(chain.pop(), nextaddy=packet.nextaddy)
             outer = OuterHeader(rem_data, 0)
             header = outer.make_header()
-            for h in range(numheads):
-                desobj = DES3.new(outer.inner.des3key,
-                                  DES3.MODE_CBC,
-                                  IV=outer.inner.pktinfo.ivs[h])
-                packet.headers[h] = desobj.encrypt(packet.headers[h])
-            # All the headers are sorted, now we need to encrypt the payload
-            # with the same IV as the final header.
-            desobj = DES3.new(outer.inner.des3key,
-                              DES3.MODE_CBC,
-                              IV=outer.inner.pktinfo.ivs[18])
-            packet.dbody = desobj.encrypt(packet.dbody)
+            ivs = outer.inner.pktinfo.ivs
+            # Each header is encrypted with its own IV and the payload with
+            # the same IV as the final header.  All of them share a single
+            # 3DES key schedule.
+            segments = [(ivs[h], packet.headers[h]) for h in range(numheads)]
+            segments.append((ivs[18], packet.dbody))
+            encrypted = Utils.MultiCBC(outer.inner.des3key).encrypt(segments)
+            packet.dbody = encrypted.pop()
+            packet.headers = encrypted
             assert len(packet.dbody) == 10240
             packet.headers.insert(0, header)
             packet.nextaddy = rem_data['email']
-        pad = Crypto.Random.get_random_bytes((20 - len(packet.headers)) * 512)
+        pad = Utils.randbytes((20 - len(packet.headers)) * 512)
         packet.payload = ''.join(packet.headers) + pad + packet.dbody
         assert len(packet.payload) == 20480
 
@@ -331,47 +472,41 @@ class Mixmaster(object):
         # We always want to send the message to the outer-most remailer.
         # Outer-most implies, the last remailer we encoded to.
         msgobj.add_header('To', packet.nextaddy)
-        msgobj.set_payload(mixprep(packet.payload))
+        msgobj.set_payload(Armor.armor(packet.payload))
         return msgobj
 
-    def nodedata(self, name=None, exit=False):
-        """Select a remailer by shortname (or email) and return the dictionary
-           object stored in the Pubring for that remailer.
-        """
-        if name is None:
-            if exit:
-                name = self.chain.get_exit()
-            else:
-                name = self.chain.get_node()
-        rem_data = self.pubring[name]
-        log.debug("Retrieved Pubkey data for: %s <%s>",
-                  name, rem_data['email'])
-        return rem_data
+
+def packets(length):
+    """Return the number of packets required for a dbody of length Bytes.
+    """
+    return max(1, (length + 10235) // 10236)
+
+
+def compress(head, data):
+    """Return the destination and header fields in head followed by the
+       user data.  If enabled, the user data is gzip compressed when that
+       reduces the number of packets the message requires.
+    """
+    threshold = config.getint('general', 'compress')
+    if (threshold == 0 or len(data) < threshold or
+        len(head) + len(data) <= 10236 or data.startswith("\x1f\x8b")):
+        return head + data
+    z = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    gz = z.compress(data) + z.flush()
+    before = packets(len(head) + len(data))
+    after = packets(len(head) + len(gz))
+    if after >= before:
+        return head + data
+    log.debug("Compressed user data from %s to %s packets", before, after)
+    return head + gz
 
 
-def mixprep(binary):
-    """Take a binary string, encode it as Base64 and wrap it to lines of
-       length n.
+def _encode_worker(n):
+    """Entry point for encoding worker processes.  The Mixmaster object
+       and the list of jobs are inherited from the parent when the worker
+       is forked.
     """
-    # This is the wrap width for Mixmaster Base64
-    n = 40
-    length = len(binary)
-    digest = MD5.new(data=binary).digest().encode("base64")
-    s = binary.encode("base64")
-    s = ''.join(s.split("\n"))
-    header = "::\n"
-    header += ("Remailer-Type: mixmaster-%s\n\n"
-               % config.get('general', 'version'))
-    header += "-----BEGIN REMAILER MESSAGE-----\n"
-    header += "%s\n" % length
-    # No \n after digest.  The Base64 encoding adds it.
-    header += "%s" % digest
-    payload = ""
-    while len(s) > 0:
-        payload += s[:n] + "\n"
-        s = s[n:]
-    payload += "-----END REMAILER MESSAGE-----\n"
-    return header + payload
+    return _worker_encode.encode_packet(*_worker_jobs[n])
 
 
 log = logging.getLogger("Pymaster.%s" % __name__)
@@ -396,3 +531,44 @@ if (__name__ == "__main__"):
     payload.email2payload()
     outmsg = encode.makemsg(payload)
     encode.dummy()
+
+    # Time the encoding of messages up to the 255 chunk limit, serially and
+    # across a pool of worker processes.
+    import time
+    log.setLevel(logging.WARN)
+    procs = max(multiprocessing.cpu_count(), 2)
+    print "%-10s %7s %12s %12s" % ("Bytes", "Chunks", "Serial",
+                                   "%s Workers" % procs)
+    for size in (10000, 100000, 1000000, 2500000):
+        msg.set_payload(Crypto.Random.get_random_bytes(size))
+        payload = Payload(msg)
+        payload.email2payload()
+        times = []
+        for workers in (1, procs):
+            encode.workers = workers
+            start = time.time()
+            msgs = encode.makemsg(payload)
+            times.append(time.time() - start)
+        print "%-10s %7s %10.2f s %10.2f s" % (size, len(msgs),
+                                               times[0], times[1])
+
+    # Compare the packets, and so RSA operations, needed for plain text
+    # messages with and without compression.  The source files serve as
+    # the text.
+    import glob
+    import os.path
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    text = "".join([open(fn).read()
+                    for fn in sorted(glob.glob(os.path.join(srcdir, "*.py")))])
+    hops = 4
+    print "%-10s %18s %18s" % ("Bytes", "Packets (RSA ops)", "Compressed")
+    for size in (20000, 50000, 150000):
+        msg.set_payload(text[:size])
+        counts = []
+        for threshold in ('0', '1'):
+            config.set('general', 'compress', threshold)
+            payload = Payload(msg)
+            payload.email2payload()
+            n = packets(len(payload.dbody))
+            counts.append("%s (%s)" % (n, n * hops))
+        print "%-10s %18s %18s" % (size, counts[0], counts[1])
@@ -25,6 +25,7 @@ import os
 import os.path
 import logging
 import shelve  # Required for packetid and chunk logs
+import time
 from Config import config
 import Utils
 import timing
@@ -84,6 +85,70 @@ class PacketID():
         log.info("Synced and closed the Packet ID log.")
 
 
+class DigestID(object):
+    """Packet IDs can only be checked after the expensive RSA decryption of
+       a packet header.  This class logs the MD5 digest of each packet
+       received so that byte-identical copies can be dropped before any
+       public key work.  Entries expire after a configured period and the
+       log is limited to a maximum number of entries, oldest first.
+    """
+    def __init__(self):
+        logfile = config.get('general', 'digestlog')
+        digestlog = shelve.open(logfile, flag='c', writeback=False)
+        # An in-memory copy of the log makes lookups and eviction cheap.
+        # The shelve provides persistence across restarts.
+        self.cache = dict(digestlog)
+        self.digestlog = digestlog
+        self.maxsize = config.getint('general', 'digestmax')
+        self.expire = timing.dhms_secs(config.get('general', 'digestexp'))
+        self.nextprune = timing.future(hours=1)
+        log.info("Packet Digest log initialized. Entries=%s, MaxEntries=%s, "
+                 "Expire=%s", len(self.cache), self.maxsize,
+                 config.get('general', 'digestexp'))
+
+    def hit(self, digest):
+        """Record a digest and return True if it was already known.
+        """
+        known = digest in self.cache
+        now = int(time.time())
+        self.cache[digest] = now
+        self.digestlog[digest] = now
+        if len(self.cache) > self.maxsize:
+            self.evict(len(self.cache) - int(self.maxsize * 0.9))
+        return known
+
+    def evict(self, num):
+        """Delete the oldest num digests from the log.
+        """
+        oldest = sorted(self.cache, key=self.cache.get)[:num]
+        for digest in oldest:
+            del self.cache[digest]
+            del self.digestlog[digest]
+        log.debug("Evicted %s digests from the Packet Digest log.", num)
+
+    def prune(self):
+        """Hourly deletion of digests that have exceeded the expiry period.
+        """
+        if timing.now() > self.nextprune:
+            before = len(self.cache)
+            cutoff = int(time.time()) - self.expire
+            for digest, seen in self.cache.items():
+                if seen < cutoff:
+                    del self.cache[digest]
+                    del self.digestlog[digest]
+            self.digestlog.sync()
+            self.nextprune = timing.future(hours=1)
+            log.debug("Packet Digest prune complete. Before=%s, After=%s.",
+                      before, len(self.cache))
+
+    def sync(self):
+        self.digestlog.sync()
+
+    def close(self):
+        self.digestlog.close()
+        log.info("Synced and closed the Packet Digest log.")
+
+
 class ChunkID(object):
     """Mixmaster contructs outbound packets of equal size (20480 Bytes),
        regardless of the message size.  When the message content exceeds the
@@ -153,19 +218,23 @@ class ChunkID(object):
         return False
 
     def assemble(self, messageid, packet):
+        """Prepare a packet for reassembly of a chunked message.  Only the
+           first chunk is read into memory as it contains the headers.  The
+           filenames of the remaining chunks are stored in the packet so they
+           can be streamed from disk when the message is written to the pool.
+        """
         iditems = self.pktlog[messageid]
         numchunks = iditems['numchunks']
         log.debug("Reassembling chunked message using %s chunks.", numchunks)
-        for i in range(1, numchunks + 1):
-            infile = iditems[str(i)]
-            content = open(infile, 'r')
-            if i == 1:
-                packet.set_chunk_dbody(content.read())
-            else:
-                packet.append_dbody(content.read())
-            content.close()
+        content = open(iditems['1'], 'rb')
+        packet.set_chunk_dbody(content.read())
+        content.close()
+        chunkfiles = [iditems[str(i)] for i in range(2, numchunks + 1)]
+        packet.set_chunkfiles(chunkfiles)
         length = len(packet.dbody)
-        log.debug("Reassembled a %s Byte message", length)
+        for infile in chunkfiles:
+            length += os.path.getsize(infile)
+        log.debug("Reassembling a %s Byte message", length)
 
     def prune(self):
         if timing.now() > self.nextday:
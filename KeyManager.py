@@ -22,14 +22,21 @@
 
 import struct
 import sys
+import os
 import os.path
+import collections
+import datetime
+import marshal
 import logging
+import multiprocessing
 import Crypto.Random
 import Crypto.Util.number
 from Crypto.PublicKey import RSA
 from Crypto.Hash import MD5
-from Crypto.Cipher import DES3
+from Crypto.Cipher import DES3, PKCS1_v1_5
 import timing
+import Watcher
+import Utils
 from Config import config
 
 
@@ -115,14 +122,175 @@ class KeyUtils():
             return x % m
 
 
+# Increment this whenever the content of keyring snapshots changes.
+SNAPSHOT_VERSION = 3
+# Marshal has no datetime type so datetimes are stored as tuples starting
+# with this tag.
+SNAPSHOT_DATETIME = "\x00datetime"
+# The types that can be stored in a snapshot as they are.
+SNAPSHOT_PLAIN = frozenset([str, unicode, int, long, float, type(None)])
+
+
+def _freeze(obj):
+    """Convert parsed keyring data to types marshal can store.
+    """
+    if isinstance(obj, datetime.datetime):
+        return (SNAPSHOT_DATETIME,) + obj.timetuple()[:6] + (obj.microsecond,)
+    if isinstance(obj, dict):
+        return dict([(_freeze(k), _freeze(v)) for k, v in obj.items()])
+    if isinstance(obj, list):
+        return [_freeze(o) for o in obj]
+    if isinstance(obj, tuple):
+        return tuple([_freeze(o) for o in obj])
+    return obj
+
+
+def _thaw(obj):
+    """The reverse of _freeze.  Marshal can also rebuild code objects so
+       anything other than plain data raises a ValueError.  Most of a
+       snapshot is strings, which are passed over without a call.
+    """
+    kind = type(obj)
+    if kind is tuple:
+        if len(obj) == 8 and obj[0] == SNAPSHOT_DATETIME:
+            return datetime.datetime(*obj[1:])
+        return tuple([o if type(o) in SNAPSHOT_PLAIN else _thaw(o)
+                      for o in obj])
+    if kind is list:
+        return [o if type(o) in SNAPSHOT_PLAIN else _thaw(o) for o in obj]
+    if kind is dict:
+        thawed = {}
+        for k, v in obj.iteritems():
+            if not type(k) in SNAPSHOT_PLAIN:
+                k = _thaw(k)
+            if not type(v) in SNAPSHOT_PLAIN:
+                v = _thaw(v)
+            thawed[k] = v
+        return thawed
+    if kind in SNAPSHOT_PLAIN:
+        return obj
+    raise ValueError("Unexpected %s in snapshot" % kind.__name__)
+
+
+class Snapshot():
+    """A marshalled copy of the parsed content of a keyring, stored
+       alongside it.  A snapshot is only used while the keyring's size,
+       mtime, inode and digest match those it was taken from.  Secret
+       snapshots are encrypted under the passphrase in the same manner as
+       the Secring.
+    """
+    def __init__(self, source, secret=False):
+        self.source = source
+        self.path = source + ".snapshot"
+        self.secret = secret
+
+    def stat(self):
+        stat = os.stat(self.source)
+        return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+    def read_source(self):
+        """Return the content of the keyring and the tuple that identifies
+           that content.
+        """
+        stat = self.stat()
+        f = open(self.source, 'r')
+        content = f.read()
+        f.close()
+        return content, stat + (MD5.new(data=content).digest(),)
+
+    def load(self):
+        """Return the data stored in the snapshot if it was taken from the
+           current content of the keyring, otherwise None.  The keyring is
+           only read and hashed when its size, mtime and inode match.
+        """
+        if not os.path.isfile(self.path):
+            return None
+        f = open(self.path, 'rb')
+        snap = f.read()
+        f.close()
+        if self.secret:
+            snap = self.decrypt(snap)
+        try:
+            version, ident, data = marshal.loads(snap)
+            if version != SNAPSHOT_VERSION or ident[:3] != self.stat():
+                return None
+            data = _thaw(data)
+        except (ValueError, EOFError, TypeError):
+            log.info("%s: Unreadable keyring snapshot", self.path)
+            return None
+        if self.read_source()[1] != ident:
+            return None
+        log.debug("%s: Loaded keyring snapshot", self.path)
+        return data
+
+    def save(self, ident, data):
+        snap = marshal.dumps((SNAPSHOT_VERSION, ident, _freeze(data)), 2)
+        if self.secret:
+            snap = self.encrypt(snap)
+        tmp = self.path + ".tmp"
+        try:
+            f = open(tmp, 'wb')
+            f.write(snap)
+            f.close()
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            log.warn("%s: Unable to write keyring snapshot: %s", self.path, e)
+
+    def cipher(self, iv):
+        pwhash = MD5.new(data=config.get('general', 'passphrase')).digest()
+        return DES3.new(pwhash, DES3.MODE_CBC, IV=iv)
+
+    def encrypt(self, snap):
+        plain = MD5.new(data=snap).digest() + snap
+        plain += "\x00" * (-len(plain) % 8)
+        iv = Crypto.Random.get_random_bytes(8)
+        return iv + struct.pack('<I', len(snap)) + \
+               self.cipher(iv).encrypt(plain)
+
+    def decrypt(self, snap):
+        """Return the decrypted snapshot, or an empty string if it can't be
+           decrypted with the current passphrase.
+        """
+        if len(snap) < 28 or (len(snap) - 12) % 8 != 0:
+            return ""
+        length = struct.unpack('<I', snap[8:12])[0]
+        plain = self.cipher(snap[0:8]).decrypt(snap[12:])
+        data = plain[16:16 + length]
+        if MD5.new(data=data).digest() != plain[0:16]:
+            return ""
+        return data
+
+
+class SecringError(Exception):
+    pass
+
+
 class Secring(KeyUtils):
     def __init__(self):
+        if (config.getint('keys', 'rotate_days') >=
+            config.getint('keys', 'validity_days')):
+            # Every successor key would be due for rotation as soon as it
+            # was generated.
+            raise SecringError("rotate_days must be less than validity_days")
         self.secring = config.get('keys', 'secring')
+        self.snapshot = Snapshot(self.secring, secret=True)
         # State that we last did a Cache reload at some arbitrary date in the
         # past.
         self.last_cache = timing.dateobj('2000-01-01')
+        # The Watcher generation of the Secring when it was last read.
+        self.filegen = 0
         # The cache will hold all the keys (as objects, keyed by keyid).
         self.cache = {}
+        # The negative cache holds keyids we've been asked for but don't
+        # have.  Once a keyid is in it, requests for it are rejected without
+        # attempting to reload the Secring until the next daily reload.
+        self.negative = collections.OrderedDict()
+        self.negative_max = config.getint('keys', 'negative_cache')
+        # The background process generating a successor key, if one is
+        # running.
+        self.rotator = None
+        # A failed rotation isn't retried until this time.
+        self.rotate_after = timing.now()
         if not os.path.isfile(self.secring):
             # If the Secret Keyring doesn't exist, we certainly want to
             # generate a new keypair.
@@ -145,19 +313,47 @@ class Secring(KeyUtils):
     def __setitem__(self, keyid, keytup):
         self.cache[keyid] = keytup
 
+    def unknown(self, keyid):
+        """Return True if keyid is known not to be in the Secring.  This is
+           a cheap test that can be made before any other packet processing.
+           Keyids are only held until the next daily Secring reload is due,
+           or until the Secring is modified.
+        """
+        if keyid not in self.negative:
+            return False
+        if timing.last_midnight() > self.last_cache or self.modified():
+            # A reload is due so give the keyid another chance.
+            self.negative.clear()
+            return False
+        return True
+
+    def modified(self):
+        """Return True if the Secring has changed since it was last read.
+        """
+        return Watcher.generation(self.secring) != self.filegen
+
+    def add_unknown(self, keyid):
+        """Add a keyid to the negative cache, discarding the oldest entry if
+           the cache is full.
+        """
+        self.negative[keyid] = True
+        if len(self.negative) > self.negative_max:
+            self.negative.popitem(last=False)
+
     def __getitem__(self, keyid):
         if type(keyid) != str or len(keyid) != 32 or not self.ishex(keyid):
             return None
         if not keyid in self.cache:
+            if self.unknown(keyid):
+                return None
             self.read_secring(ignore_date=False)
             if not keyid in self.cache:
+                self.add_unknown(keyid)
                 return None
         key, expires, grace = self.cache[keyid]
         if self.date_expired(expires):
-            # Key has expired.  Check if we have another valid key and if not,
-            # create a new keypair.
-            if len(self.cache) == 1:
-                self.newkeys()
+            # Key has expired.  Its successor is generated in advance by
+            # rotate() so it's only accepted until its grace expires.
             if self.date_expired(grace):
                 # Key is beyond its expiry and grace.  Delete it from the
                 # Cache, never again to be trusted.
@@ -165,6 +361,56 @@ class Secring(KeyUtils):
                 return None
         return key
 
+    def rotate_due(self):
+        """Return True if no cached key remains valid beyond the rotation
+           period.
+        """
+        horizon = timing.future(days=config.getint('keys', 'rotate_days'))
+        for key, expires, grace in self.cache.values():
+            if expires > horizon:
+                return False
+        return True
+
+    def rotate(self):
+        """Generate a successor key in a background process when the
+           current keys are close to expiry.  This is called periodically;
+           once the process has published the new key, the Secring is
+           reread so the key is ready for use.  Nothing waits for the key
+           to be generated.
+        """
+        if self.rotator is not None:
+            if self.rotator.is_alive():
+                return
+            self.rotator.join()
+            if self.rotator.exitcode == 0:
+                log.info("Key rotation complete.  Rereading Secring.")
+                self.read_secring()
+                if self.rotate_due():
+                    # The new key isn't in use, so generating another
+                    # won't help.  Wait as if the rotation had failed.
+                    self.rotate_after = timing.dhms_future(
+                        config.get('keys', 'rotate_retry'))
+                    log.warn("Successor key isn't valid beyond the rotation "
+                             "period.  Retrying after %s",
+                             timing.timestamp(self.rotate_after))
+            else:
+                self.rotate_after = timing.dhms_future(
+                    config.get('keys', 'rotate_retry'))
+                log.warn("Key rotation failed with exit code %s.  Retrying "
+                         "after %s", self.rotator.exitcode,
+                         timing.timestamp(self.rotate_after))
+            self.rotator = None
+        elif timing.now() >= self.rotate_after and self.rotate_due():
+            log.info("Starting background generation of a successor key.")
+            self.rotator = multiprocessing.Process(target=self.rotate_keys)
+            self.rotator.daemon = True
+            self.rotator.start()
+
+    def rotate_keys(self):
+        Utils.child_init()
+        os.nice(19)
+        self.newkeys()
+
     def test(self):
         """ This test demonstrates why Mixmaster cannot use bigger RSA keys.
         If the key size is increased from 1024 to 2048 Bytes, the 24 Byte
@@ -182,7 +428,10 @@ class Secring(KeyUtils):
     def newkeys(self):
         """Generate a new Secret/Public key and write them to the configured
         files.  In the case of the Secret Key, it's appended to Secring.  The
-        Public Key overwrites the existing file.
+        Public Key overwrites the existing file.  Each file is written under
+        a temporary name and renamed into place so that readers only ever see
+        a complete keyring.  The Secring is written first so that the secret
+        key is available before the public key can be distributed.
         """
 
         log.debug("Generating new keypair")
@@ -198,7 +447,12 @@ class Secring(KeyUtils):
         today = timing.today()
         expire = timing.datestamp(timing.future(
                                  days=config.getint('keys', 'validity_days')))
-        f = open(config.get('keys', 'secring'), 'a')
+        secring = config.get('keys', 'secring')
+        f = open(secring + '.tmp', 'w')
+        if os.path.isfile(secring):
+            old = open(secring, 'r')
+            f.write(old.read())
+            old.close()
         f.write('-----Begin Mix Key-----\n')
         f.write('Created: %s\n' % today)
         f.write('Expires: %s\n' % expire)
@@ -208,9 +462,11 @@ class Secring(KeyUtils):
         f.write('%s\n' % self.wrap(secenc.encode("base64"), 40))
         f.write('-----End Mix Key-----\n\n')
         f.close()
+        os.rename(secring + '.tmp', secring)
         log.debug("Secret Key written to %s",
                       config.get('keys', 'secring'))
-        f = open(config.get('keys', 'pubkey'), 'w')
+        pubkey = config.get('keys', 'pubkey')
+        f = open(pubkey + '.tmp', 'w')
         f.write('%s ' % config.get('general', 'shortname'))
         f.write('%s ' % config.get('mail', 'address'))
         f.write('%s ' % keyid)
@@ -227,6 +483,7 @@ class Secring(KeyUtils):
         f.write('%s\n' % self.wrap(public.encode("base64"), 40))
         f.write('-----End Mix Key-----\n\n')
         f.close()
+        os.rename(pubkey + '.tmp', pubkey)
         log.debug("Public Key written to %s",
                       config.get('keys', 'pubkey'))
 
@@ -292,14 +549,44 @@ class Secring(KeyUtils):
         -----End Mix Key-----
         """
 
-        if not ignore_date and timing.last_midnight() <= self.last_cache:
+        if (not ignore_date and timing.last_midnight() <= self.last_cache
+            and not self.modified()):
             log.debug("Not repopulating Secret Key cache.  This task is only "
-                      "performed, at most, once per day.")
+                      "performed, at most, once per day or when the Secring "
+                      "is modified.")
             return 0
         log.debug("Reading Secring to cache Secret Keys.")
-        f = open(self.secring)
+        self.negative.clear()
+        self.filegen = Watcher.generation(self.secring)
+        keys = self.snapshot.load()
+        if keys is None:
+            content, ident = self.snapshot.read_source()
+            keys = self.parse_secring(content)
+            self.snapshot.save(ident, keys)
+        for keyid, created, expires, plainkey in keys:
+            if self.date_prevalid(created) or self.date_expired(expires):
+                # Ignore this key, it's not valid at this time.
+                continue
+            keyobj = self.sec_construct(plainkey)
+            log.info("Cached valid secret key: %s" % keyid)
+            # The cache contains three objects: The key, the expiration
+            # date of the key and the grace period beyond expiration.
+            self.cache[keyid] = (keyobj, expires, self.date_grace(expires))
+        # This timestamp is used to ensure we don't repeatedly attempt to
+        # cache a key that doesn't exist.
+        self.last_cache = timing.last_midnight()
+        log.debug("Cache written on %s.  Cache will not be rewritten today "
+                  "unless a restart occurs.",
+                  timing.datestamp(self.last_cache))
+
+    def parse_secring(self, content):
+        """Parse the content of a secring.mix file and return a list of
+           tuples containing the keyid, creation date, expiry date and
+           decrypted key of every key within it.
+        """
+        keys = []
         inkey = False
-        for line in f:
+        for line in content.splitlines(True):
             if line.startswith("-----Begin Mix Key-----"):
                 if inkey:
                     log.warn("Got an unexpected Begin Mix Key cutmark "
@@ -320,10 +607,6 @@ class Secring(KeyUtils):
                 created = timing.dateobj(line.split(": ")[1].rstrip())
             elif lcount == 2 and line.startswith("Expires:"):
                 expires = timing.dateobj(line.split(": ")[1].rstrip())
-                if (self.date_prevalid(created) or
-                    self.date_expired(expires)):
-                    # Ignore this key, it's not valid at this time.
-                    inkey = False
             elif lcount == 3 and len(line) == 33:
                 keyid = line.rstrip()
             elif lcount == 4:
@@ -338,12 +621,7 @@ class Secring(KeyUtils):
                     log.warn("%s: Decrypted key is not 712 Bytes!",
                                  len(plainkey))
                 elif keyid == MD5.new(data=plainkey[2:258]).hexdigest():
-                    keyobj = self.sec_construct(plainkey)
-                    log.info("Cached valid secret key: %s" % keyid)
-                    # The cache contains three objects: The key, the expiration
-                    # date of the key and the grace period beyond expiration.
-                    self.cache[keyid] = (keyobj, expires,
-                                         self.date_grace(expires))
+                    keys.append((keyid, created, expires, plainkey))
                 else:
                     log.warn("Read a Secret key but the stated KeyID (%s)"
                              "doesn't match the key digest.  The only "
@@ -353,13 +631,7 @@ class Secring(KeyUtils):
                 continue
             else:
                 key += line
-        # This timestamp is used to ensure we don't repeatedly attempt to
-        # cache a key that doesn't exist.
-        self.last_cache = timing.last_midnight()
-        log.debug("Cache written on %s.  Cache will not be rewritten today "
-                  "unless a restart occurs.",
-                  timing.datestamp(self.last_cache))
-        f.close()
+        return keys
 
     def decrypt(self, keybin, iv):
         # Hash a textual password and then use that hash, along with the
@@ -382,6 +654,17 @@ class Pubring(KeyUtils):
         if not os.path.isfile(pubring):
             raise PubringError("%s: Pubring not found" % pubring)
         self.pubring = pubring
+        self.snapshot = Snapshot(pubring)
+        # Encryption contexts keyed by keyid.  A keyid is the digest of its
+        # key so these survive a reload unless the key itself changes.
+        self.ciphers = {}
+        # Parsed key blocks, keyed by the digest of the block's text.
+        self.blocks = {}
+        # The cache starts empty and is populated by the first reload.
+        self.cache = {}
+        # Incremented whenever a reload adds, removes or changes a remailer
+        # so that anything derived from the Pubring can tell it's stale.
+        self.generation = 0
         self.read_pubring()
         log.info("Initialized Pubring. Path=%s, Keys=%s",
                  pubring, len(self.cache))
@@ -390,10 +673,20 @@ class Pubring(KeyUtils):
         # header[0] Shortname
         # header[1] Email Address
         # header[2] KeyID
-        # header[3] RSA Key Object
+        # header[3] PKCS1 Cipher Object
         # header[4] Mixmaster Version
         # header[5] Capstring
         self.recache()
+        return self.lookup(name)
+
+    def resolve(self, names):
+        """Return the dictionaries for a list of names, such as a chain,
+           with the Pubring file only checked for modification once.
+        """
+        self.recache()
+        return [self.lookup(name) for name in names]
+
+    def lookup(self, name):
         if name in self.snindex:
             # The requested name is a shortname.  Change the request to the
             # corresponding email address.
@@ -401,17 +694,35 @@ class Pubring(KeyUtils):
         if not name in self.cache:
             # The requested name isn't a know remailer email address.
             raise PubringError("%s: Public Key not found" % name)
-        if ('validto' in self.cache[name] and
-            self.date_expired(self.cache[name]['validto'])):
+        if ('expires' in self.cache[name] and
+            self.date_expired(self.cache[name]['expires'])):
             # This is a later style Mixmaster key so we can try to validate
             # the dates on it.
             log.info("Key for %s has expired.  Deleting it from the "
                      "cache.", self.cache[name]['shortname'])
-            # Public Key has expired.
+            # Public Key has expired.  Anything derived from the cache,
+            # such as the Chain stats, needs to know it's gone.
+            shortname = self.cache[name]['shortname']
+            if self.snindex.get(shortname) == name:
+                del self.snindex[shortname]
             del self.cache[name]
+            self.generation += 1
             raise PubringError("%s: Public Key has expired" % name)
+        remailer = self.cache[name]
+        if not 'cipher' in remailer:
+            remailer['cipher'] = self.cipher(remailer)
         # Return the dictionary relating to the requested name.
-        return self.cache[name]
+        return remailer
+
+    def cipher(self, remailer):
+        """Return the PKCS1 encryption context for a remailer's key.  Keys
+           are only constructed the first time they're used.
+        """
+        keyid = remailer['keyid']
+        if not keyid in self.ciphers:
+            keyobj = self.pub_construct(remailer['key'])
+            self.ciphers[keyid] = PKCS1_v1_5.new(keyobj)
+        return self.ciphers[keyid]
 
     def get_addresses(self):
         self.recache()
@@ -421,6 +732,13 @@ class Pubring(KeyUtils):
         self.recache()
         return self.snindex.keys()
 
+    def get_capstrings(self):
+        """Return a dictionary of capstrings keyed by shortname.
+        """
+        self.recache()
+        return dict([(name, self.cache[email]['capstring'])
+                     for name, email in self.snindex.items()])
+
     def pub_construct(self, key):
         length = struct.unpack("<H", key[0:2])[0]
         pub = (Crypto.Util.number.bytes_to_long(key[2:130]),
@@ -456,27 +774,50 @@ class Pubring(KeyUtils):
             valid = False
         if not self.ishex(remailer['keyid']):
             valid = False
-        if ('validfrom' in remailer and
-            self.date_prevalid(remailer['validfrom'])):
+        return valid
+
+    def date_valid(self, remailer):
+        """Return True if the dates on a remailer's key, where it has them,
+           make it valid at this time.
+        """
+        valid = True
+        if ('created' in remailer and
+            self.date_prevalid(remailer['created'])):
             # Mixmaster > v3.0 enable validation of key date validity.
                 valid = False
-        if ('validto' in remailer and
-            self.date_expired(remailer['validto'])):
+        if ('expires' in remailer and
+            self.date_expired(remailer['expires'])):
                 valid = False
         return valid
 
     def recache(self):
         # If the file has been modified since the last read, it's worth
         # reading it again.
-        if os.path.getmtime(self.pubring) > self.mtime:
+        if Watcher.generation(self.pubring) != self.filegen:
             log.debug("%s modified. Recreating rules.", self.pubring)
             self.read_pubring()
 
     def read_pubring(self):
         """Read the Public Keyring file and cache the results in a dictionary,
            keyed by email address.  In addition, create an index of shortnames
-           to email addresses.
+           to email addresses.  The parsed keys are taken from the snapshot
+           when the Pubring hasn't changed since it was written.  Remailers
+           whose key blocks are unchanged keep their existing cache entries,
+           along with any cipher created for them.
         """
+        # Taken before reading so that a change made during the read
+        # triggers another.
+        self.filegen = Watcher.generation(self.pubring)
+        remailers = self.snapshot.load()
+        if remailers is None:
+            content, ident = self.snapshot.read_source()
+            remailers = self.parse_blocks(content)
+            self.snapshot.save(ident, remailers)
+        elif not self.blocks:
+            for remailer in remailers:
+                self.blocks.setdefault(remailer['fingerprint'],
+                                       []).append(remailer)
+        added = changed = 0
         # The cache is keyed by remailer email address and contains all the
         # related data in a list.
         cache = {}
@@ -487,14 +828,77 @@ class Pubring(KeyUtils):
         # Headers is a list of the remailer header lines found in the Pubring.
         # This is used to list known remailers in remailer-conf replies.
         headers = []
-        f = open(self.pubring, 'r')
+        for remailer in remailers:
+            if not self.date_valid(remailer):
+                continue
+            current = self.cache.get(remailer['email'])
+            if current is None:
+                added += 1
+            elif current['fingerprint'] != remailer['fingerprint']:
+                changed += 1
+            else:
+                remailer = current
+            if remailer is not current:
+                # The parsed remailers are shared with the blocks and the
+                # snapshot so the cache gets its own copy.
+                remailer = dict(remailer)
+            headers.append(remailer['headline'])
+            # Here we key the cache by remailer email address.
+            cache[remailer['email']] = remailer
+            # Populate the shortname index.
+            snindex[remailer['shortname']] = remailer['email']
+        # Drop the contexts of keys that are no longer in the Pubring.
+        keyids = set([r['keyid'] for r in cache.values()])
+        for keyid in self.ciphers.keys():
+            if not keyid in keyids:
+                del self.ciphers[keyid]
+        removed = len([e for e in self.cache if not e in cache])
+        if added or changed or removed:
+            self.generation += 1
+            log.debug("Pubring generation %s: Added=%s, Changed=%s, "
+                      "Removed=%s", self.generation, added, changed, removed)
+        self.cache = cache
+        self.snindex = snindex
+        self.headers = headers
+
+    def parse_blocks(self, content):
+        """Split the content of a pubring.mix file into key blocks and return
+           a list of the remailers they contain.  Blocks parsed by a previous
+           reload are not parsed again.
+        """
+        blocks = {}
+        remailers = []
+        cutmark = "-----End Mix Key-----"
+        pieces = content.split(cutmark)
+        for n, block in enumerate(pieces):
+            if not block.strip():
+                continue
+            if n < len(pieces) - 1:
+                block += cutmark
+            fingerprint = MD5.new(data=block).hexdigest()
+            if fingerprint in self.blocks:
+                parsed = self.blocks[fingerprint]
+            else:
+                parsed = self.parse_pubring(block)
+                for remailer in parsed:
+                    remailer['fingerprint'] = fingerprint
+            blocks[fingerprint] = parsed
+            remailers.extend(parsed)
+        self.blocks = blocks
+        return remailers
+
+    def parse_pubring(self, content):
+        """Parse the content of a pubring.mix file and return a list of
+           remailer dictionaries, one for each valid key within it.
+        """
+        remailers = []
         # Bool to indicate when an actual key is being read.  Set True by
         # "Begin Mix Key" cutmarks and False by "End Mix Key" cutmarks.
         inkey = False
         # This remains False until we get a valid header, then it is populated
         # with the remailer's email address.
         gothead = False
-        for line in f:
+        for line in content.splitlines():
             line = line.rstrip()
             if not gothead and not inkey:
                 # The components of a pubkey header are delimited by a
@@ -512,13 +916,12 @@ class Pubring(KeyUtils):
                                 'email':     header[1],
                                 'keyid':     header[2],
                                 'version':   header[3],
-                                'capstring': header[4]}
+                                'capstring': header[4],
+                                'headline':  line}
                     if len(header) == 7:
                         remailer['validfrom'] = header[5]
                         remailer['validto'] = header[6]
                     gothead = self.header_validate(remailer)
-                    if gothead:
-                        headline = line
             elif (gothead and not inkey and
                 line.startswith("-----Begin Mix Key-----")):
                 inkey = True
@@ -531,16 +934,17 @@ class Pubring(KeyUtils):
                     keyid == MD5.new(data=key[2:258]).hexdigest() and
                     keyid == remailer['keyid']):
                     # We want this key please!
-                    headers.append(headline)
-                    # The key object itself is inserted as the fourth element
-                    # in the list.  No good reason, other than it needs to be
-                    # inserted at some fixed point and the total length is
-                    # varible, depending on whether dates are present.
-                    remailer['keyobj'] = self.pub_construct(key)
-                    # Here we key the cache by remailer email address.
-                    cache[remailer['email']] = remailer
-                    # Populate the shortname index.
-                    snindex[remailer['shortname']] = remailer['email']
+                    # Only the raw key is stored here.  The key object and
+                    # its cipher are created when the remailer is first
+                    # used.
+                    remailer['key'] = key
+                    if 'validto' in remailer:
+                        # Parsed once here so lookups and reloads needn't.
+                        remailer['created'] = timing.dateobj(
+                                                  remailer['validfrom'])
+                        remailer['expires'] = timing.dateobj(
+                                                  remailer['validto'])
+                    remailers.append(remailer)
                     gothead = False
                     inkey = False
             elif gothead and inkey:
@@ -558,12 +962,7 @@ class Pubring(KeyUtils):
             else:
                 raise PubringError("Unexpected line in Pubring: %s"
                                    % line.rstrip())
-        f.close()
-        self.cache = cache
-        self.snindex = snindex
-        self.headers = headers
-        # Reset the modified file time
-        self.mtime = os.path.getmtime(self.pubring)
+        return remailers
 
 
 log = logging.getLogger("Pymaster.%s" % __name__)
@@ -582,3 +981,112 @@ if (__name__ == "__main__"):
     #if remailer is not None:
     #    print remailer[0], remailer[1]
     #    print s[remailer[1]]
+
+    # Compare reloading the Pubring and encrypting session keys with and
+    # without lazily constructed, cached cipher contexts.
+    import time
+    import tempfile
+    iterations = 200
+    names = p.get_names()
+    start = time.time()
+    for n in range(iterations):
+        p.read_pubring()
+        for name in names:
+            p.pub_construct(p.cache[p.snindex[name]]['key'])
+    eager = (time.time() - start) / iterations
+    start = time.time()
+    for n in range(iterations):
+        p.read_pubring()
+    lazy = (time.time() - start) / iterations
+    print "Reload (%s keys): eager %.2f msecs, lazy %.2f msecs" % (
+          len(names), eager * 1000, lazy * 1000)
+    deskey = Crypto.Random.get_random_bytes(24)
+    remailer = p[names[0]]
+    start = time.time()
+    for n in range(iterations):
+        keyobj = p.pub_construct(remailer['key'])
+        PKCS1_v1_5.new(keyobj).encrypt(deskey)
+    fresh = (time.time() - start) / iterations
+    start = time.time()
+    for n in range(iterations):
+        p[names[0]]['cipher'].encrypt(deskey)
+    cached = (time.time() - start) / iterations
+    print "Session key: fresh %.1f usecs, cached %.1f usecs" % (
+          fresh * 1000000, cached * 1000000)
+    # Compare parsing a Pubring of several hundred remailers with loading
+    # it from its snapshot.
+    keyblock = "-----Begin Mix Key-----\n%s\n%s\n%s\n" \
+               "-----End Mix Key-----\n\n" % (
+               remailer['keyid'], len(remailer['key']),
+               p.pub_deconstruct(p.pub_construct(remailer['key'])))
+    fd, bigring = tempfile.mkstemp()
+    f = os.fdopen(fd, 'w')
+    for n in range(500):
+        f.write("rem%03d rem%03d@domain.invalid %s %s %s\n\n%s" % (
+                n, n, remailer['keyid'], remailer['version'],
+                remailer['capstring'], keyblock))
+    f.close()
+    p.pubring = bigring
+    p.snapshot = Snapshot(bigring)
+    p.read_pubring()
+    start = time.time()
+    for n in range(iterations):
+        p.parse_pubring(p.snapshot.read_source()[0])
+    parsed = (time.time() - start) / iterations
+    start = time.time()
+    for n in range(iterations):
+        p.read_pubring()
+    snapped = (time.time() - start) / iterations
+    print "Startup (%s keys): parsed %.2f msecs, snapshot %.2f msecs" % (
+          len(p.cache), parsed * 1000, snapped * 1000)
+    # Compare full and incremental reloads when a single remailer changes.
+    f = open(bigring, 'r')
+    content = f.read()
+    f.close()
+    versions = [content, content.replace(" rem000@", " newrem@", 1)]
+    timings = []
+    for incremental in (False, True):
+        start = time.time()
+        for n in range(iterations):
+            f = open(bigring, 'w')
+            f.write(versions[n % 2])
+            f.close()
+            if not incremental:
+                p.blocks = {}
+                p.cache = {}
+            p.read_pubring()
+        timings.append((time.time() - start) / iterations)
+    print "Reload after one change: full %.2f msecs, incremental %.2f msecs" \
+          % (timings[0] * 1000, timings[1] * 1000)
+    os.remove(bigring)
+    os.remove(p.snapshot.path)
+
+    # A snapshot is only loaded while its keyring is unchanged.  A change
+    # that keeps the size and mtime is caught by the digest and a changed
+    # inode by the stat.
+    fd, ring = tempfile.mkstemp()
+    os.write(fd, "keyring one\n")
+    os.close(fd)
+    snapshot = Snapshot(ring)
+    data = [{'created': datetime.datetime(2013, 1, 2, 3, 4, 5),
+             'key': "\x00\xff" * 64, 'version': 3}]
+    snapshot.save(snapshot.read_source()[1], data)
+    assert snapshot.load() == data
+    mtime = os.path.getmtime(ring)
+    f = open(ring, 'w')
+    f.write("keyring two\n")
+    f.close()
+    os.utime(ring, (mtime, mtime))
+    assert snapshot.load() is None
+    snapshot.save(snapshot.read_source()[1], data)
+    assert snapshot.load() == data
+    os.rename(ring, ring + ".old")
+    f = open(ring, 'w')
+    f.write("keyring two\n")
+    f.close()
+    os.utime(ring, (mtime, mtime))
+    assert snapshot.load() is None
+    os.remove(ring + ".old")
+    os.remove(ring)
+    os.remove(snapshot.path)
+    print "Stale snapshots are ignored"
@@ -24,10 +24,13 @@ import sys
 import os.path
 import logging
 import mailbox
+import multiprocessing
 import email
+import email.parser
 import smtplib
 from Config import config
 import DecodePacket
+import Pool
 import Utils
 
 
@@ -35,46 +38,253 @@ class MailError(Exception):
     pass
 
 
+class DuplicatePacket(Exception):
+    """Raised when a packet is byte-identical to one already received"""
+    pass
+
+
 class MailMessage():
-    def __init__(self, pubring, secring, idlog, encode, chunkmgr):
+    def __init__(self, pubring, secring, idlog, encode, chunkmgr, digestlog):
         maildir = config.get('paths', 'maildir')
         self.inbox = mailbox.Maildir(maildir, factory=None, create=False)
         decode = DecodePacket.Mixmaster(secring, idlog, chunkmgr)
         self.decode = decode
         self.server = config.get('mail', 'server')
+        self.workers = config.getint('general', 'workers')
         self.pubring = pubring
         self.encode = encode
-        log.info("Initialized Mail handler. Mailbox=%s, Server=%s",
-                  maildir, self.server)
+        self.digestlog = digestlog
+        # A running total of RSA decryptions avoided by dropping duplicate
+        # packets.
+        self.rsa_saved_total = 0
+        log.info("Initialized Mail handler. Mailbox=%s, Server=%s, "
+                 "Workers=%s", maildir, self.server, self.workers)
 
     def iterate_mailbox(self):
         log.debug("Beginning mailbox processing")
-        self.smtp = smtplib.SMTP(self.server)
         messages = self.inbox.keys()
         self.added_to_pool = 0
         self.dummy_msgs = 0
         self.remailer_foo_msgs = 0
         self.failed_msgs = 0
-        for k in messages:
-            try:
-                self.mail2pool(k)
-            except MailError, e:
-                log.debug("Mail Error: %s", e)
-                self.failed_msgs += 1
-            self.inbox.remove(k)
+        self.oversize_msgs = 0
+        self.rsa_saved = 0
+        self.unknown_keys = 0
+        self.negative_hits = 0
+        # The worker pool is forked before the SMTP connection is opened so
+        # the workers don't inherit the socket.
+        workers = None
+        if self.workers > 1 and len(messages) > 1:
+            entries = self.screen_messages(messages)
+            pending = [n for n, (k, packet, error) in enumerate(entries)
+                       if packet is not None]
+            if pending:
+                workers = self.start_workers(entries, len(pending))
+                decrypted = workers.imap(_decrypt_worker, pending,
+                                         chunksize=4)
+        else:
+            entries = [(k, None, None) for k in messages]
+        self.smtp = smtplib.SMTP(self.server)
+        try:
+            # Results are returned in the same order as the packets were
+            # handed out.  This process is the only writer to the PacketID
+            # and Chunk logs, so replay detection is as exact as it would be
+            # with no workers.
+            for k, packet, error in entries:
+                try:
+                    if packet is not None:
+                        packet, error = decrypted.next()
+                    if isinstance(error, DuplicatePacket):
+                        log.debug("%s: Duplicate packet digest", k)
+                        self.rsa_saved += 1
+                    elif isinstance(error, DecodePacket.UnknownKeyError):
+                        # Workers can't update our negative cache so it's
+                        # done here, ready for the next batch.
+                        self.decode.secring.add_unknown(error.args[0])
+                        self.unknown_key(error)
+                    elif error is not None:
+                        log.debug("Mixmaster decryption failed: %s", error)
+                        self.failed_msgs += 1
+                    elif packet is not None:
+                        self.decode.attach_rules(packet)
+                        self.packet2pool(k, packet)
+                    else:
+                        self.mail2pool(k)
+                except MailError, e:
+                    log.debug("Mail Error: %s", e)
+                    self.failed_msgs += 1
+                self.inbox.remove(k)
+        except:
+            if workers is not None:
+                workers.terminate()
+                workers.join()
+            raise
+        if workers is not None:
+            # Every result has been collected so the workers can be left
+            # to exit on their own.
+            workers.close()
+            workers.join()
+        self.rsa_saved_total += self.rsa_saved
         log.debug("Mail processing complete. Processed=%s, Pooled=%s, "
-                  "Text=%s, dummies=%s, Failed=%s",
+                  "Text=%s, dummies=%s, Failed=%s, Oversize=%s, "
+                  "RSA-Saved=%s (Total=%s), UnknownKey=%s (Cached=%s), "
+                  "RuleCache=%.0f%%/%.0f%% (Dest/Head)",
                   len(messages), self.added_to_pool, self.remailer_foo_msgs,
-                  self.dummy_msgs, self.failed_msgs)
+                  self.dummy_msgs, self.failed_msgs, self.oversize_msgs,
+                  self.rsa_saved, self.rsa_saved_total, self.unknown_keys,
+                  self.negative_hits,
+                  self.decode.destrules.hit_ratio() * 100,
+                  self.decode.headrules.hit_ratio() * 100)
         self.inbox.close()
         self.smtp.quit()
 
-    def mail2pool(self, msgkey):
-        # The following lines read an email file and store it as a Python
-        # email object.
+    def screen_messages(self, messages):
+        """Read every message in a batch before any are handed to the
+           decryption workers.  Packets that duplicate one already logged,
+           or an earlier one in this batch, are dropped here so no worker
+           spends an RSA decryption on them.  Returns a list of (msgkey,
+           packet, error) tuples.  Messages with neither a packet nor an
+           error aren't plain Mixmaster packets and are left to mail2pool.
+        """
+        entries = []
+        for k in messages:
+            try:
+                packet = self.read_packet(k)
+            except DecodePacket.ValidationError, e:
+                entries.append((k, None, e))
+                continue
+            if packet is not None and self.digestlog.hit(packet.digest):
+                entries.append((k, None, DuplicatePacket()))
+            else:
+                entries.append((k, packet, None))
+        return entries
+
+    def start_workers(self, entries, numpackets):
+        """Fork a pool of decryption workers.  Each worker inherits a copy of
+           this object, including the Secret Keyring, and the screened
+           entries so the pool is created afresh on each pass of the
+           mailbox.
+        """
+        global _worker_mail, _worker_entries
+        _worker_mail = self
+        _worker_entries = entries
+        procs = min(self.workers, numpackets)
+        log.debug("Starting %s decryption workers for %s packets",
+                  procs, numpackets)
+        return multiprocessing.Pool(procs, initializer=Utils.child_init)
+
+    def read_message(self, msgkey):
+        """Read a Maildir file and return it as a Python email object.
+        """
         mailfile = self.inbox.get_file(msgkey)
         msg = email.message_from_file(mailfile)
         mailfile.close()
+        return msg
+
+    def read_headers(self, lines):
+        """Consume lines up to the end of the message headers and return
+           them as a Python email object with no payload.
+        """
+        headers = []
+        for line in lines:
+            if len(line) == 0:
+                break
+            headers.append(line)
+        return email.parser.Parser().parsestr("\n".join(headers) + "\n",
+                                              headersonly=True)
+
+    def is_plain(self, msg):
+        """Return True if a message's headers suggest it's nothing more than
+           a Mixmaster packet.  Anything with a Subject could be a
+           remailer-foo request and bounces and multipart messages need
+           special handling.
+        """
+        if 'Subject' in msg or msg.get_content_maintype() == 'multipart':
+            return False
+        name, addy = email.utils.parseaddr(msg['From'])
+        return not addy.lower().startswith("mailer-daemon")
+
+    def read_packet(self, msgkey):
+        """Stream a Maildir file into a Mixmaster packet object.  Only the
+           headers are parsed as an email object; the body is passed line by
+           line to the packet parser which gives up as soon as it's clear the
+           message isn't valid.  Returns None if the message isn't plain.
+        """
+        mailfile = self.inbox.get_file(msgkey)
+        try:
+            lines = Utils.readlines(mailfile)
+            if not self.is_plain(self.read_headers(lines)):
+                return None
+            return self.decode.lines2packet(lines)
+        except Utils.LineLengthError, e:
+            raise DecodePacket.ValidationError(str(e))
+        finally:
+            mailfile.close()
+
+    def decrypt_packet(self, packet):
+        """This function runs inside a decryption worker.  It performs all
+           the public key and symmetric decryption for a screened packet but
+           never writes to the pool or the ID logs.  The return is a tuple
+           of (packet, error).
+        """
+        try:
+            self.decode.packet_decrypt(packet)
+            self.decode.decrypt_payload(packet)
+        except DecodePacket.ValidationError, e:
+            return None, e
+        return packet, None
+
+    def mail2pool(self, msgkey):
+        try:
+            # Most inbound messages are plain Mixmaster packets.  These are
+            # streamed straight from the Maildir file to a packet object.
+            packet = self.read_packet(msgkey)
+        except DecodePacket.ValidationError, e:
+            log.debug("Invalid Mixmaster message: %s", e)
+            self.failed_msgs += 1
+            return 0
+        if packet is None:
+            packet = self.mail2packet(msgkey)
+            if packet is None:
+                return 0
+        if self.digestlog.hit(packet.digest):
+            # We've seen this exact packet before.  There's no need to spend
+            # an RSA decryption discovering it's a replay.
+            log.debug("%s: Duplicate packet digest", msgkey)
+            self.rsa_saved += 1
+            return 0
+        try:
+            # The packet is encrypted so we now decrypt it and convert the
+            # content into a email message object fit for sending.
+            self.decode.packet_decrypt(packet)
+            self.decode.decrypt_payload(packet)
+        except DecodePacket.UnknownKeyError, e:
+            self.unknown_key(e)
+            return 0
+        except DecodePacket.ValidationError, e:
+            log.debug("Mixmaster decryption failed: %s", e)
+            self.failed_msgs += 1
+            return 0
+        self.packet2pool(msgkey, packet)
+
+    def unknown_key(self, e):
+        """Count packets rejected because they're encrypted to an unknown
+           key, distinguishing those caught by the negative cache.
+        """
+        keyid, cached = e.args
+        log.debug("%s: Secret Key not found", keyid)
+        self.unknown_keys += 1
+        if cached:
+            self.negative_hits += 1
+
+    def mail2packet(self, msgkey):
+        """Handle messages that aren't plain Mixmaster packets.  These might
+           be bounces, remailer-foo requests or packets with a Subject.  A
+           packet object is returned if the message contains one.
+        """
+        # The following lines read an email file and store it as a Python
+        # email object.
+        msg = self.read_message(msgkey)
         name, addy = email.utils.parseaddr(msg['From'])
         # TODO the following file write is for debugging purposes during
         # development.
@@ -89,36 +299,35 @@ class MailMessage():
         # is, respond to it and move on to the next message.
         if self.remailer_foo(msg):
             self.remailer_foo_msgs += 1
-            return 0
+            return None
         try:
             # email2packet takes an email object and returns a mixmaster
             # packet object.
-            packet = self.decode.email2packet(msg)
+            return self.decode.email2packet(msg)
         except DecodePacket.ValidationError, e:
             log.debug("Invalid Mixmaster message: %s", e)
             self.failed_msgs += 1
-            return 0
-        try:
-            # The packet is encrypted so we now decrypt it and convert the
-            # content into a email message object fit for sending.
-            self.decode.packet_decrypt(packet)
-        except DecodePacket.ValidationError, e:
-            log.debug("Mixmaster decryption failed: %s", e)
-            self.failed_msgs += 1
-            return 0
+            return None
+
+    def packet2pool(self, msgkey, packet):
+        """Write a decrypted packet to the pool.  This is always performed
+           by the parent process, regardless of where decryption happened.
+        """
         try:
-            self.decode.unpack(packet)
+            self.decode.write_packet(packet)
             self.added_to_pool += 1
+        except DecodePacket.OversizeError, e:
+            log.info("Rejected oversize message: %s", e)
+            self.oversize_msgs += 1
+            return 0
         except DecodePacket.ValidationError, e:
             log.debug("Unpack failed: %s", e)
             self.failed_msgs += 1
             return 0
         except DecodePacket.DestinationError:
-            log.debug("Re-encoding this message for Random Hop.")
-            #TODO We don't currently handle randhopping of big messages.
-            if len(packet.dbody) <= 10236:
-                self.encode.randhop(packet)
-                self.added_to_pool += 1
+            log.debug("Pooling this message for Random Hop.")
+            Pool.write_randhop(packet.dbody)
+            self.added_to_pool += 1
         except DecodePacket.DummyMessage, e:
             log.debug("%s: Dummy message", msgkey)
             self.dummy_msgs += 1
@@ -232,6 +441,16 @@ class MailMessage():
         return msg
 
 
+def _decrypt_worker(n):
+    """Entry point for decryption worker processes.  The MailMessage object
+       and the screened entries are inherited from the parent when the
+       worker is forked.
+    """
+    return _worker_mail.decrypt_packet(_worker_entries[n][1])
+
+
+_worker_mail = None
+_worker_entries = None
 log = logging.getLogger("Pymaster.%s" % __name__)
 if (__name__ == "__main__"):
     logfmt = config.get('logging', 'format')
@@ -25,10 +25,111 @@ import os.path
 import logging
 import email
 import smtplib
+import multiprocessing
+import struct
+import time
 from Config import config
 from Crypto.Random import random
+from Crypto.Cipher import DES3
+from Crypto.Hash import MD5
+import Armor
+import Chain
+import EncodePacket
 import timing
 import Utils
+import Watcher
+
+
+# Binary pool entries hold a packet for an intermediate hop, preceded by
+# this fixed layout metadata record:
+#   Entry version                  [        1 byte]
+#   Entry type                     [        1 byte]
+#   Arrival time                   [       4 bytes]
+#   Next hop address               [      80 bytes]
+ENTRY = struct.Struct('<BBI80s')
+ENTRY_VERSION = 1
+ENTRY_PACKET = 0
+
+
+class PoolError(Exception):
+    pass
+
+
+def write_packet(nextaddy, binary):
+    """Write a packet for the next hop remailer to the pool.  It's kept in
+       binary and only armored when it's sent.
+    """
+    assert len(binary) == Armor.PACKETSIZE and len(nextaddy) <= 80
+    f = open(Utils.pool_filename('b'), 'wb')
+    f.write(ENTRY.pack(ENTRY_VERSION, ENTRY_PACKET, int(time.time()),
+                       nextaddy))
+    f.write(binary)
+    f.close()
+
+
+def read_packet(fqfn):
+    """Return a tuple of the next hop address, arrival time and binary
+       packet from a pool entry written by write_packet.
+    """
+    f = open(fqfn, 'rb')
+    entry = f.read()
+    f.close()
+    if len(entry) != ENTRY.size + Armor.PACKETSIZE:
+        raise PoolError("Incorrect packet entry length")
+    version, entry_type, arrived, nextaddy = ENTRY.unpack(entry[:ENTRY.size])
+    if version != ENTRY_VERSION or entry_type != ENTRY_PACKET:
+        raise PoolError("Unknown packet entry version or type")
+    nextaddy = nextaddy.rstrip("\x00")
+    if not nextaddy:
+        raise PoolError("No recipient specified")
+    return nextaddy, arrived, entry[ENTRY.size:]
+
+
+def write_randhop(dbody):
+    """Write a decrypted message body to the pool for randhopping.  The
+       chain is selected and the body encoded when the pool sends it, so
+       only this compact entry is written during intake.  It's encrypted
+       under the passphrase, as the Secring is:
+           Initialization vector          [  8 bytes]
+           3DES encrypted:
+               Digest of body             [ 16 bytes]
+               Length of body             [  4 bytes]
+               Body                       [  varies ]
+               Random padding             [to 8 byte boundary]
+    """
+    plain = MD5.new(data=dbody).digest() + struct.pack('<I', len(dbody))
+    plain += dbody
+    plain += Utils.randbytes(-len(plain) % 8)
+    iv = Utils.randbytes(8)
+    f = open(Utils.pool_filename('r'), 'wb')
+    f.write(iv + _poolcipher(iv).encrypt(plain))
+    f.close()
+
+
+def read_randhop(fqfn):
+    """Return the body from a pool entry written by write_randhop.
+    """
+    f = open(fqfn, 'rb')
+    entry = f.read()
+    f.close()
+    if len(entry) < 32 or len(entry) % 8 != 0:
+        raise PoolError("Malformed randhop entry")
+    plain = _poolcipher(entry[0:8]).decrypt(entry[8:])
+    length = struct.unpack('<I', plain[16:20])[0]
+    dbody = plain[20:20 + length]
+    if len(dbody) != length or MD5.new(data=dbody).digest() != plain[0:16]:
+        raise PoolError("Randhop entry digest failed")
+    return dbody
+
+
+def sender():
+    return "%s <%s>" % (config.get('general', 'longname'),
+                        config.get('mail', 'address'))
+
+
+def _poolcipher(iv):
+    pwhash = MD5.new(data=config.get('general', 'passphrase')).digest()
+    return DES3.new(pwhash, DES3.MODE_CBC, IV=iv)
 
 
 class Pool():
@@ -40,6 +141,7 @@ class Pool():
         self.pooldir = config.get('paths', 'pool')
         # We need the packet encoder in order to generate dummy messages.
         self.encode = encode
+        self.reservoir = DummyReservoir(encode)
         log.info("Initialised pool. Path=%s, Interval=%s, Rate=%s%%, "
                  "Size=%s.",
                  self.pooldir, self.interval, self.rate, self.size)
@@ -50,40 +152,110 @@ class Pool():
         if timing.now() < self.next_process:
             return 0
         log.debug("Beginning Pool processing.")
+        files = self.pick_files()
+        randhops = self.encode_randhops(files)
         smtp = smtplib.SMTP(config.get('mail', 'server'))
-        for fn in self.pick_files():
+        for fn in files:
+            fqfn = os.path.join(config.get('paths', 'pool'), fn)
+            log.debug("Pool processing: %s", fn)
+            if fn.startswith('r'):
+                if not fn in randhops:
+                    continue
+                for msg in randhops[fn]:
+                    self.send(smtp, msg)
+                self.delete(fqfn)
+                continue
+            if fn.startswith('b'):
+                try:
+                    nextaddy, arrived, binary = read_packet(fqfn)
+                except PoolError, e:
+                    log.warn("%s: %s", fn, e)
+                    self.delete(fqfn)
+                    continue
+                log.debug("%s: Pooled for %s seconds", fn,
+                          int(time.time()) - arrived)
+                self.send_packet(smtp, nextaddy, binary)
+                self.delete(fqfn)
+                continue
             if not fn.startswith('m'):
-                # Currently all messages are prefixed with an m.
                 continue
-            fqfn = os.path.join(config.get('paths', 'pool'), fn)
             f = open(fqfn, 'r')
             msg = email.message_from_file(f)
             f.close()
-            log.debug("Pool processing: %s", fn)
             if not 'To' in msg:
                 log.warn("%s: Malformed pool message. No recipient "
                          "specified.", fn)
                 continue
-            msg["Message-ID"] = Utils.msgid()
-            msg["Date"] = email.Utils.formatdate()
-            msg["From"] = "%s <%s>" % (config.get('general', 'longname'),
-                                       config.get('mail', 'address'))
-            try:
-                smtp.sendmail(msg["From"], msg["To"], msg.as_string())
-                log.debug("Email sent to: %s", msg["To"])
-            except smtplib.SMTPRecipientsRefused, e:
-                log.warn("SMTP failed with: %s", e)
+            self.send(smtp, msg)
             self.delete(fqfn)
         smtp.quit()
         # Outbound dummy message generation.
         if random.randint(0, 100) < config.get('pool', 'outdummy'):
-            log.debug("Generating dummy message.")
-            self.encode.dummy()
+            log.debug("Injecting dummy message.")
+            self.reservoir.inject()
         # Return the time for the next pool processing.
         self.next_process = timing.dhms_future(self.interval)
         log.debug("Next pool process at %s",
                   timing.timestamp(self.next_process))
 
+    def encode_randhops(self, files):
+        """Randhops are encoded at send time, to an exit chosen from the
+           current stats.  Every randhop selected for this pass is encoded
+           in a single batch, before the SMTP session is opened.  A dict of
+           the encoded messages, keyed by filename, is returned.
+        """
+        jobs = []
+        entries = []
+        for fn in files:
+            if not fn.startswith('r'):
+                continue
+            fqfn = os.path.join(config.get('paths', 'pool'), fn)
+            try:
+                fnjobs = self.encode.randhop_jobs(read_randhop(fqfn))
+            except PoolError, e:
+                log.warn("%s: %s", fn, e)
+                self.delete(fqfn)
+                continue
+            except EncodePacket.EncodeError, e:
+                log.warn("%s: Randhop encoding failed: %s", fn, e)
+                self.delete(fqfn)
+                continue
+            except Chain.ChainError, e:
+                # Without a usable exit the entry stays in the pool and is
+                # retried on a later pass.
+                log.warn("%s: Randhop chain failed: %s", fn, e)
+                continue
+            entries.append((fn, len(fnjobs)))
+            jobs.extend(fnjobs)
+        msgs = self.encode.encode_jobs(jobs)
+        randhops = {}
+        for fn, count in entries:
+            randhops[fn] = msgs[:count]
+            del msgs[:count]
+        return randhops
+
+    def send(self, smtp, msg):
+        msg["Message-ID"] = Utils.msgid()
+        msg["Date"] = email.Utils.formatdate()
+        msg["From"] = sender()
+        self.sendmail(smtp, msg["To"], msg.as_string())
+
+    def send_packet(self, smtp, nextaddy, binary):
+        """Send a binary packet to the next hop.  The headers are written
+           directly and the packet armored as the message is put together.
+        """
+        headers = ("To: %s\nMessage-ID: %s\nDate: %s\nFrom: %s\n\n"
+                   % (nextaddy, Utils.msgid(), email.Utils.formatdate(),
+                      sender()))
+        self.sendmail(smtp, nextaddy, headers + Armor.armor(binary))
+
+    def sendmail(self, smtp, recipient, text):
+        try:
+            smtp.sendmail(sender(), recipient, text)
+            log.debug("Email sent to: %s", recipient)
+        except smtplib.SMTPRecipientsRefused, e:
+            log.warn("SMTP failed with: %s", e)
+
     def delete(self, fqfn):
         """Delete files from the Mixmaster Pool."""
         os.remove(fqfn)
@@ -116,6 +288,132 @@ class Pool():
         return poolfiles[start:end]
 
 
+class DummyReservoir():
+    """A directory of ready-made dummy messages, kept topped up by a low
+       priority background process.  Injecting a dummy into the pool is then
+       just a rename.  Dummies are named after the modification times of the
+       stats and Pubring files they were encoded against.  When either file
+       changes, the existing dummies are discarded and the reservoir refills.
+    """
+    def __init__(self, encode):
+        self.encode = encode
+        self.size = config.getint('pool', 'reservoir')
+        self.path = config.get('paths', 'dummies')
+        # How long the producer sleeps when the reservoir is full or the
+        # system is busy.
+        self.interval = 10
+        self.producer = None
+        # The Watcher generations of the stats and Pubring when the stamp
+        # was last worked out.
+        self.generations = None
+        self.current = None
+
+    def stamp(self):
+        """Return the filename prefix for dummies encoded against the
+           current stats and Pubring.  Watcher generations are private to
+           each process so the prefix is made from the modification times,
+           which the producer and the pool agree on.  These are only read
+           again when the Watcher reports a change.
+        """
+        mlist2 = config.get('keys', 'mlist2')
+        pubring = config.get('keys', 'pubring')
+        generations = (Watcher.generation(mlist2), Watcher.generation(pubring))
+        if generations != self.generations:
+            self.current = "d%x-%x-" % (int(os.path.getmtime(mlist2)),
+                                        int(os.path.getmtime(pubring)))
+            self.generations = generations
+        return self.current
+
+    def ready(self, stamp):
+        """Return the filenames of dummies with the given stamp.  Any other
+           dummies are stale and are deleted.  An unreadable reservoir is
+           treated as empty.
+        """
+        current = []
+        try:
+            filenames = os.listdir(self.path)
+        except OSError, e:
+            log.warn("Dummy reservoir unavailable: %s", e)
+            return current
+        for fn in filenames:
+            if fn.startswith(stamp):
+                current.append(fn)
+            elif fn.startswith("d"):
+                try:
+                    os.remove(os.path.join(self.path, fn))
+                except OSError:
+                    # The other process got to it first.
+                    pass
+        return current
+
+    def start(self):
+        """Fork the producer process.  It exits when its parent does.
+        """
+        if self.size < 1:
+            log.info("Dummy reservoir disabled.")
+            return
+        self.producer = multiprocessing.Process(target=self.produce,
+                                                args=(os.getpid(),))
+        self.producer.daemon = True
+        self.producer.start()
+        log.info("Started dummy producer. Reservoir=%s, Path=%s",
+                 self.size, self.path)
+
+    def produce(self, parent):
+        Utils.child_init()
+        os.nice(19)
+        cpus = multiprocessing.cpu_count()
+        # Partly written dummies left by a previous producer.
+        try:
+            for fn in os.listdir(self.path):
+                if fn.startswith("t"):
+                    os.remove(os.path.join(self.path, fn))
+        except OSError, e:
+            log.warn("Unable to tidy dummy reservoir: %s", e)
+        while os.getppid() == parent:
+            stamp = self.stamp()
+            if (len(self.ready(stamp)) >= self.size or
+                os.getloadavg()[0] >= cpus):
+                time.sleep(self.interval)
+                continue
+            try:
+                self.make_dummy(stamp)
+            except Chain.ChainError, e:
+                log.warn("Dummy encoding failed: %s", e)
+                time.sleep(self.interval)
+            except (IOError, OSError), e:
+                log.warn("Unable to write dummy to reservoir: %s", e)
+                time.sleep(self.interval)
+
+    def make_dummy(self, stamp):
+        """Encode a dummy and move it into the reservoir once it's
+           completely written.
+        """
+        for msg in self.encode.dummy_msgs():
+            fn = Utils.randbytes(8).encode("hex")
+            tmp = os.path.join(self.path, "t" + fn)
+            f = open(tmp, 'w')
+            f.write(msg.as_string())
+            f.close()
+            os.rename(tmp, os.path.join(self.path, stamp + fn))
+
+    def inject(self):
+        """Move a ready dummy into the pool.  If the reservoir is empty,
+           fall back to encoding one.
+        """
+        for fn in self.ready(self.stamp()):
+            try:
+                os.rename(os.path.join(self.path, fn),
+                          Utils.pool_filename('m'))
+                log.debug("Injected dummy from reservoir.")
+                return
+            except OSError:
+                # Deleted as stale by the producer.
+                continue
+        log.debug("Dummy reservoir is empty.")
+        self.encode.dummy()
+
+
 log = logging.getLogger("Pymaster.%s" % __name__)
 if (__name__ == "__main__"):
     logfmt = config.get('logging', 'format')
@@ -127,3 +425,70 @@ if (__name__ == "__main__"):
     handler = logging.StreamHandler()
     handler.setFormatter(logging.Formatter(fmt=logfmt, datefmt=datefmt))
     log.addHandler(handler)
+
+    def new_entry(write, *args):
+        """Call a pool writer and return the path of the entry it wrote.
+        """
+        pooldir = config.get('paths', 'pool')
+        before = set(os.listdir(pooldir))
+        write(*args)
+        fn, = set(os.listdir(pooldir)) - before
+        return os.path.join(pooldir, fn)
+
+    # Randhop entries must return the body they were written with and
+    # reject any that have been tampered with.
+    for dbody in ("", "x", Utils.randbytes(10240), Utils.randbytes(30001)):
+        fqfn = new_entry(write_randhop, dbody)
+        assert os.path.basename(fqfn).startswith('r')
+        assert read_randhop(fqfn) == dbody
+        f = open(fqfn, 'r+b')
+        f.seek(20)
+        f.write(chr(ord(f.read(1)) ^ 1))
+        f.close()
+        try:
+            read_randhop(fqfn)
+            assert False, "Tampered randhop entry accepted"
+        except PoolError:
+            pass
+        os.remove(fqfn)
+    print "Randhop entries round trip"
+
+    # Binary packet entries must return the address and packet they were
+    # written with, and reject truncated entries.
+    binary = Utils.randbytes(Armor.PACKETSIZE)
+    nextaddy = "a" * 70 + "@x.invalid"
+    fqfn = new_entry(write_packet, nextaddy, binary)
+    assert os.path.basename(fqfn).startswith('b')
+    readaddy, arrived, readbinary = read_packet(fqfn)
+    assert (readaddy, readbinary) == (nextaddy, binary)
+    assert abs(arrived - time.time()) < 60
+    f = open(fqfn, 'r+b')
+    f.truncate(ENTRY.size + Armor.PACKETSIZE - 1)
+    f.close()
+    try:
+        read_packet(fqfn)
+        assert False, "Truncated packet entry accepted"
+    except PoolError:
+        pass
+    os.remove(fqfn)
+    print "Packet entries round trip"
+
+    # Compare the time taken to inject a dummy from the reservoir with
+    # encoding one during pool processing.
+    import KeyManager
+    encode = EncodePacket.Mixmaster(KeyManager.Pubring())
+    reservoir = DummyReservoir(encode)
+    iterations = 50
+    stamp = reservoir.stamp()
+    for n in range(iterations):
+        reservoir.make_dummy(stamp)
+    start = time.time()
+    for n in range(iterations):
+        encode.dummy()
+    encoded = (time.time() - start) / iterations
+    start = time.time()
+    for n in range(iterations):
+        reservoir.inject()
+    injected = (time.time() - start) / iterations
+    print "Encoded:  %.1f msecs per dummy" % (encoded * 1000)
+    print "Injected: %.1f msecs per dummy" % (injected * 1000)
@@ -54,7 +54,7 @@ msg['Newsgroups'] = 'news.group'
 msg.set_payload("Test Message")
 payload = EncodePacket.Payload(msg)
 payload.email2payload()
-inmsg = encode.makemsg(payload, chainstr='pymaster,pymaster,pymaster')
+inmsg = encode.makemsg(payload, chainstr='pymaster,pymaster,pymaster')[0]
 ismix = mixmail.email2packet(inmsg)
 if ismix:
     packet = mixmail.get_packet()
@@ -21,11 +21,14 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from Config import config
+from Crypto.Cipher import DES3
 import Crypto.Random
+import struct
+import os
+import signal
 import os.path
 import timing
 import logging
-import re
 
 
 def capstring():
@@ -44,12 +47,80 @@ def capstring():
     return caps
 
 
-def pool_filename(prefix):
-    """Make up a suitably random filename for the pool entry.
+class RandomReservoir(object):
+    """Random Bytes are drawn from the PyCrypto RNG in large blocks and
+       served in slices, so a packet's many small requests don't each
+       re-enter the Fortuna generator.  After a fork the inherited block is
+       discarded and the RNG reseeded; otherwise the parent and child would
+       serve the same Bytes.
     """
+    def __init__(self, blocksize=65536):
+        self.blocksize = blocksize
+        self.pid = None
+        self.block = ""
+        self.pos = 0
+        # Counts of requests served and of calls to the RNG.
+        self.requests = 0
+        self.refills = 0
+
+    def get(self, n):
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.block = ""
+            self.pos = 0
+            Crypto.Random.atfork()
+        self.requests += 1
+        if n > self.blocksize:
+            self.refills += 1
+            return Crypto.Random.get_random_bytes(n)
+        if self.pos + n > len(self.block):
+            self.block = Crypto.Random.get_random_bytes(self.blocksize)
+            self.pos = 0
+            self.refills += 1
+        data = self.block[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+
+_reservoir = RandomReservoir()
+
+
+def randbytes(n):
+    """Return n random Bytes from the per-process reservoir.
+    """
+    return _reservoir.get(n)
+
+
+def randint(n):
+    """Return a random Integer in the range 0 to n-1, drawn from the
+       reservoir.  Values that would bias the result are discarded.
+    """
+    limit = 0x100000000 - (0x100000000 % n)
     while True:
-        fn = prefix + Crypto.Random.get_random_bytes(8).encode("hex")
-        fq = os.path.join(config.get('paths', 'pool'), fn)
+        r = struct.unpack('<I', randbytes(4))[0]
+        if r < limit:
+            return r % n
+
+
+def child_init():
+    """Prepare a forked child process.  The daemon's SIGTERM handler
+       closes the parent's logs and stops the daemon, so children go back
+       to the default handler and simply exit.  The RNG is reseeded so the
+       child doesn't share the parent's state.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    Crypto.Random.atfork()
+
+
+def pool_filename(prefix, path=None):
+    """Make up a suitably random filename for the pool entry.  Path
+       overrides the configured pool directory.
+    """
+    if path is None:
+        path = config.get('paths', 'pool')
+    while True:
+        fn = prefix + randbytes(8).encode("hex")
+        fq = os.path.join(path, fn)
         if not os.path.isfile(fq):
             break
     return fq
@@ -57,33 +128,97 @@ def pool_filename(prefix):
 
 def msgid():
     return "<%s.%s@%s>" % (timing.msgidstamp(),
-                           Crypto.Random.get_random_bytes(4).encode("hex"),
+                           randbytes(4).encode("hex"),
                            config.get('mail', 'mid'))
 
 
-def file2regex(filename):
-    """Read a given file and return a list of items and, if regex formatted, a
-    compiled Regular Expression.
-
+class MultiCBC(object):
+    """Triple-DES CBC encryption and decryption of a sequence of segments,
+       each with its own IV, using a single key schedule.  Mixmaster encrypts
+       every header and the body of a packet with the same key but a
+       different IV.  Rather than creating a cipher object per segment, one
+       object is reused and the first block of each segment is corrected for
+       the chaining state left behind by the previous segment.
     """
+    def __init__(self, key):
+        self.state = "\x00" * 8
+        self.des = DES3.new(key, DES3.MODE_CBC, IV=self.state)
+
+    def _xor(self, a, b):
+        """Return the XOR of two 8 Byte strings.
+        """
+        return struct.pack('<Q', struct.unpack('<Q', a)[0] ^
+                                 struct.unpack('<Q', b)[0])
+
+    def decrypt_into(self, buf, segments):
+        """Decrypt a list of (offset, iv, ciphertext) tuples, writing each
+           plaintext into the bytearray buf at the given offset.
+        """
+        for offset, iv, ciphertext in segments:
+            length = len(ciphertext)
+            buf[offset:offset + length] = self.des.decrypt(ciphertext)
+            # The cipher object chained the first block to the end of the
+            # previous ciphertext instead of to this segment's IV.
+            first = struct.unpack_from('<Q', buf, offset)[0]
+            fix = struct.unpack('<Q', self._xor(self.state, iv))[0]
+            struct.pack_into('<Q', buf, offset, first ^ fix)
+            self.state = ciphertext[length - 8:length]
+
+    def encrypt(self, segments):
+        """Encrypt a list of (iv, plaintext) tuples and return a list of the
+           corresponding ciphertexts.
+        """
+        encrypted = []
+        for iv, plaintext in segments:
+            # Prime the first block so that XORing it with the chaining
+            # state gives the first plaintext block XOR the wanted IV.
+            first = self._xor(self._xor(plaintext[0:8], iv), self.state)
+            ciphertext = (self.des.encrypt(first) +
+                          self.des.encrypt(buffer(plaintext, 8)))
+            self.state = ciphertext[-8:]
+            encrypted.append(ciphertext)
+        return encrypted
+
+
+class LineLengthError(Exception):
+    pass
 
-    reglines = []
-    listlines = []
-    for line in file2list(filename):
-        if line.startswith("/") and line.endswith("/"):
-            reglines.append(line[1:-1])
-        else:
-            listlines.append(line.rstrip())
-    if len(reglines) == 0:
-        # No valid regex entires exist in the file.
-        compiled = False
-    else:
-        regex = '|'.join(reglines)
-        # This should never happen but best to check as || will match
-        # everything.
-        regex = regex.replace('||', '|')
-        compiled = re.compile(regex)
-    return compiled, listlines
+
+def readlines(f, blocksize=8192, maxline=998):
+    """Yield the lines of a file object, without line endings, reading it in
+       fixed size blocks.  Mailbox proxy files seek on every readline so
+       iterating them directly is very slow.  RFC 5322 limits lines to 998
+       chars; a longer line raises LineLengthError as soon as it's seen.
+    """
+    # The pieces of a line that spans blocks are only joined once it ends.
+    pending = []
+    pendlen = 0
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        lines = block.split("\n")
+        if len(lines) > 1 and pending:
+            pending.append(lines[0])
+            lines[0] = "".join(pending)
+            pending = []
+            pendlen = 0
+        last = lines.pop()
+        for line in lines:
+            line = line.rstrip("\r")
+            if len(line) > maxline:
+                raise LineLengthError("Line exceeds %s chars" % maxline)
+            yield line
+        pending.append(last)
+        pendlen += len(last)
+        # Allow for a CR at the end of the line.
+        if pendlen > maxline + 1:
+            raise LineLengthError("Line exceeds %s chars" % maxline)
+    line = "".join(pending).rstrip("\r")
+    if len(line) > maxline:
+        raise LineLengthError("Line exceeds %s chars" % maxline)
+    if line:
+        yield line
 
 
 def file2list(filename):
@@ -112,8 +247,62 @@ if (__name__ == "__main__"):
     log.addHandler(handler)
 
     print capstring()
-    print poolfn('m')
+    print pool_filename('m')
     print msgid()
+
+    # MultiCBC must give the same results as a fresh cipher per segment.
+    key = Crypto.Random.get_random_bytes(24)
+    segments = [(Crypto.Random.get_random_bytes(8),
+                 Crypto.Random.get_random_bytes(length))
+                for length in (512, 8, 328, 10240, 16)]
+    expected = [DES3.new(key, DES3.MODE_CBC, IV=iv).encrypt(plaintext)
+                for iv, plaintext in segments]
+    assert MultiCBC(key).encrypt(segments) == expected
+    offsets = [sum([len(p) for i, p in segments[:n]])
+               for n in range(len(segments))]
+    buf = bytearray(offsets[-1] + len(segments[-1][1]))
+    MultiCBC(key).decrypt_into(buf, [(offset, iv, ciphertext)
+                                     for offset, (iv, p), ciphertext in
+                                     zip(offsets, segments, expected)])
+    assert str(buf) == ''.join([p for i, p in segments])
+    print "MultiCBC matches per-IV DES3"
+
+    # Count the calls made to the RNG while encoding packets, with and
+    # without the reservoir.
+    log.setLevel(logging.WARN)
+    import time
+    import email.message
+    import KeyManager
+    import EncodePacket
+    # The encoder uses the imported module's reservoir, not this one.
+    import Utils
+    reservoir = Utils._reservoir
+    encode = EncodePacket.Mixmaster(KeyManager.Pubring())
+    iterations = 200
+    msg = email.message.Message()
+    msg['Dests'] = 'bench@domain.invalid'
+    msg.set_payload("Benchmark message")
+    payload = EncodePacket.Payload(msg)
+    payload.email2payload()
+    chainstr = "*,*,*,*"
+    for blocksize in (0, 65536):
+        # A blocksize of zero sends every request straight to the RNG.
+        reservoir.blocksize = blocksize
+        reservoir.requests = 0
+        reservoir.refills = 0
+        start = time.time()
+        for n in range(iterations):
+            encode.makemsg(payload, chainstr=chainstr)
+            Utils.pool_filename('m')
+        elapsed = (time.time() - start) / iterations
+        print "Blocksize %5s: %5.1f requests, %6.2f RNG calls, " \
+              "%.2f msecs per packet" % (blocksize,
+                                         float(reservoir.requests) /
+                                         iterations,
+                                         float(reservoir.refills) /
+                                         iterations,
+                                         elapsed * 1000)
+
     destalw = ConfFiles(config.get('etc', 'dest_alw'), 'dest_alw')
     print dir(destalw)
     print destalw.hit('steve@mixmin.net')
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# pymaster.py - A Python version of the Mixmaster Remailer
+#
+# Copyright (C) 2013 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Change notification for the files that the remailer caches the content of,
+# such as the keyrings, stats and allow/block rules.  Each watched file has a
+# generation number that increases whenever the file changes.  Anything
+# cached from a file remembers the generation it was read at and only needs
+# to compare that with the current generation to know if it's stale.
+#
+# On Linux, changes are reported by inotify.  Elsewhere, or if inotify is
+# unavailable, the files are stat'd.  Either way, the filesystem is only
+# consulted once per check interval, however often the generations are
+# requested.
+
+import os
+import os.path
+import errno
+import struct
+import time
+import logging
+import ctypes
+import ctypes.util
+from Config import config
+import timing
+
+# inotify event flags, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+# Directories are watched, rather than files, so that files replaced by a
+# rename are still reported.
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+# The fixed part of a struct inotify_event.
+EVENT = struct.Struct('iIII')
+
+
+def _libc():
+    """Return the C library if it provides inotify, otherwise None.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class Watcher():
+    def __init__(self):
+        self.interval = timing.dhms_secs(config.get('general', 'filecheck'))
+        self.nextcheck = 0
+        self.libc = _libc()
+        # The generation of each watched file, keyed by absolute path.
+        self.generations = {}
+        # The absolute path of each path requested.
+        self.abspaths = {}
+        # Paths that are stat'd on each check and their last known state.
+        self.polled = {}
+        # Watched directories, keyed by inotify watch descriptor.
+        self.wds = {}
+        self.fd = None
+        self.pid = os.getpid()
+        if self.libc is None:
+            log.info("inotify unavailable. Watched files will be polled.")
+
+    def generation(self, path):
+        """Return the current generation of path.  The first request for a
+           path starts watching it.
+        """
+        if not path in self.abspaths:
+            self.abspaths[path] = os.path.abspath(path)
+            if not self.abspaths[path] in self.generations:
+                self.watch(self.abspaths[path])
+        path = self.abspaths[path]
+        now = time.time()
+        if now >= self.nextcheck:
+            self.nextcheck = now + self.interval
+            self.check()
+        return self.generations[path]
+
+    def watch(self, path):
+        self.generations[path] = 1
+        if self.fd is None and self.libc is not None:
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self.fd < 0:
+                log.warn("inotify_init1 failed: %s",
+                         os.strerror(ctypes.get_errno()))
+                self.fd = None
+                self.libc = None
+        directory = os.path.dirname(path)
+        if self.fd is not None:
+            if directory in self.wds.values():
+                return
+            wd = self.libc.inotify_add_watch(self.fd, directory, WATCH_MASK)
+            if wd >= 0:
+                self.wds[wd] = directory
+                return
+            log.info("%s: Unable to watch directory (%s).  Polling instead.",
+                     directory, os.strerror(ctypes.get_errno()))
+        self.polled[path] = self.state(path)
+
+    def state(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def bump(self, path):
+        self.generations[path] += 1
+        log.debug("%s: Changed. Generation=%s", path, self.generations[path])
+
+    def check(self):
+        if os.getpid() != self.pid:
+            self.forked()
+        if self.fd is not None:
+            self.read_events()
+        for path, state in self.polled.items():
+            current = self.state(path)
+            if current != state:
+                self.polled[path] = current
+                self.bump(path)
+
+    def read_events(self):
+        """Read every pending inotify event.  A file that changed several
+           times since the last check only gains one generation.
+        """
+        changed = set()
+        while True:
+            try:
+                events = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(events):
+                wd, mask, cookie, length = EVENT.unpack_from(events, offset)
+                offset += EVENT.size
+                name = events[offset:offset + length].rstrip("\x00")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events have been lost so everything might have
+                    # changed.
+                    changed.update(self.generations)
+                elif mask & IN_IGNORED:
+                    # The directory has gone.  Poll its files instead.
+                    directory = self.wds.pop(wd, None)
+                    for path in self.generations:
+                        if os.path.dirname(path) == directory:
+                            self.polled[path] = None
+                elif wd in self.wds:
+                    path = os.path.join(self.wds[wd], name)
+                    if path in self.generations:
+                        changed.add(path)
+        for path in changed:
+            self.bump(path)
+
+    def forked(self):
+        """An inherited inotify descriptor is shared with the parent, which
+           would consume events meant for this process.  The child starts
+           afresh and treats every watched file as changed.
+        """
+        self.pid = os.getpid()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.wds = {}
+        self.polled = {}
+        generations = self.generations
+        self.generations = {}
+        for path in generations:
+            self.watch(path)
+            self.generations[path] = generations[path] + 1
+
+
+_watcher = None
+
+
+def generation(path):
+    """Return the generation of path from the per-process watcher.
+    """
+    global _watcher
+    if _watcher is None:
+        _watcher = Watcher()
+    return _watcher.generation(path)
+
+
+log = logging.getLogger("Pymaster.%s" % __name__)
+if (__name__ == "__main__"):
+    log = logging.getLogger("Pymaster")
+    log.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler()
+    log.addHandler(handler)
+    # Compare the cost of checking a file for modification by stat with
+    # asking the watcher for its generation.
+    import tempfile
+    iterations = 100000
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    start = time.time()
+    for n in xrange(iterations):
+        os.path.getmtime(filename)
+    stat = (time.time() - start) / iterations
+    generation(filename)
+    start = time.time()
+    for n in xrange(iterations):
+        generation(filename)
+    watched = (time.time() - start) / iterations
+    print "Check: stat %.2f usecs, generation %.2f usecs" % (
+          stat * 1000000, watched * 1000000)
+    # Measure how long a change takes to be noticed.
+    before = generation(filename)
+    f = open(filename, 'a')
+    f.write("changed\n")
+    f.close()
+    start = time.time()
+    while generation(filename) == before:
+        time.sleep(0.01)
+    print "Change noticed after %.2f secs" % (time.time() - start)
+    os.remove(filename)